@@ -5,55 +5,97 @@ Created on Aug 29, 2016
 '''
 
 import numpy as np
+import os.path
+import shutil
+import tempfile
 from collections import namedtuple
 import cPickle as pickle
-import gc #multiprocessing
-#from sklearn.model_selection import KFold
-from sklearn.cross_validation import KFold
+import gc
+from multiprocessing import Pool
+from scipy.spatial.distance import cdist
+from sklearn.model_selection import KFold
 from sklearn.utils.validation import _is_arraylike, check_X_y
-import tensorflow as tf
+from .gp_tf import SESSION_POOL
 from .util import stopwatch
 
 GridScore = namedtuple('GridScore', ['parameters', 'mean_scores', 'cv_scores'])
 
-def mp_grid_search((task_id, parameters, estimator, kf, X, y,
-                    score_fns, ntasks)):
+def load_shared(shared_dir, name):
+    return np.load(os.path.join(shared_dir, name + '.npy'), mmap_mode='r')
+
+def predict_takes_dists(estimator_cls):
+    # Estimators declare whether their predict accepts X_dists (see
+    # GPR.PREDICT_X_DISTS)
+    return getattr(estimator_cls, 'PREDICT_X_DISTS', False)
+
+def grid_search_task((param_idx, fold_idx, parameters, estimator_cls, cv,
+                      share_dists, shared_dir, score_fns)):
+    # Fits and scores one parameter setting on one fold. The data, folds
+    # and distance matrices are memory-mapped read-only from shared_dir so
+    # every worker process shares a single copy of them.
+    X = load_shared(shared_dir, 'X')
+    y = load_shared(shared_dir, 'y')
+    estimator = estimator_cls()
     estimator.set_params(**parameters)
-    sparams = estimator.get_params()
-    nfolds = kf.n_folds
-    scores = np.empty((nfolds, len(score_fns)))
-
-    for i, (train_idx, test_idx) in enumerate(kf.split(X)):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-
-        with tf.Graph().as_default():
-            estimator.fit(X_train, y_train)
-            ypreds, sigmas, _ = estimator.predict(X_test)
-        gc.collect()
-        for j,score_fn in enumerate(score_fns):
-            scores[i,j] = score_fn(y_test, ypreds, sigmas)
-        print "\tCompleted {}/{} folds".format(i+1, nfolds)
-    mean_scores = scores.mean(axis=0)
-    grid_score = GridScore(sparams, mean_scores, scores)
-    return grid_score
+    if cv == GridSearch.CV_LOO:
+        fit_kwargs = {}
+        if share_dists:
+            fit_kwargs['X_dists'] = load_shared(shared_dir, 'dists')
+        estimator.fit(X, y, **fit_kwargs)
+        res = estimator.loo_predict()
+        y_test = y
+    else:
+        train_idx = load_shared(shared_dir, 'train_idx_{}'.format(fold_idx))
+        test_idx = load_shared(shared_dir, 'test_idx_{}'.format(fold_idx))
+        fit_kwargs = {}
+        predict_kwargs = {}
+        if share_dists:
+            fit_kwargs['X_dists'] = load_shared(
+                shared_dir, 'train_dists_{}'.format(fold_idx))
+            if predict_takes_dists(estimator_cls):
+                predict_kwargs['X_dists'] = load_shared(
+                    shared_dir, 'test_dists_{}'.format(fold_idx))
+        estimator.fit(X[train_idx], y[train_idx], **fit_kwargs)
+        res = estimator.predict(X[test_idx], **predict_kwargs)
+        y_test = y[test_idx]
+    y_test = np.asarray(y_test).reshape(res.ypreds.shape)
+    scores = [score_fn(y_test, res.ypreds, res.sigmas) for score_fn in score_fns]
+    del estimator
+    gc.collect()
+    return param_idx, fold_idx, scores
 
 class GridSearch(object):
+
+    # CV_KFOLD refits the estimator on each of the nfolds folds. CV_LOO
+    # scores each parameter setting from a single fit with the estimator's
+    # closed-form leave-one-out predictions (nfolds is ignored).
+    CV_KFOLD = 'kfold'
+    CV_LOO = 'loo'
+
+    CHECKPOINT_EXT = '.p'
     
     def __init__(self, estimator_cls, parameter_grid, score_fns,
                  nfolds=10, shuffle=False, seed=None, njobs=1,
-                 checkpoint_path=None):
+                 checkpoint_path=None, cv=CV_KFOLD, share_dists=True):
+        # Each (parameter setting, fold) pair is a separate task and up to
+        # njobs of them run at once in a pool of processes. If share_dists
+        # is True then the pairwise distances of each fold are computed
+        # once and passed to the estimator's fit as X_dists, and to its
+        # predict as well if it declares PREDICT_X_DISTS.
+        assert cv in (GridSearch.CV_KFOLD, GridSearch.CV_LOO)
+        assert njobs >= 1
         self.estimator_cls = estimator_cls
         self.parameter_grid = parameter_grid
+        self.cv = cv
+        self.share_dists = share_dists
         self.nfolds = nfolds
         self.seed = seed
-        assert njobs == 1, "# jobs > 1 not supported."
         self.njobs = njobs
         assert _is_arraylike(score_fns)
         self.score_fns = score_fns
         self.checkpoint_path = checkpoint_path
         self.grid_scores = None
-        self.kf = KFold(n_folds=self.nfolds,
+        self.kf = KFold(n_splits=self.nfolds,
                         shuffle=shuffle,
                         random_state=seed)
     
@@ -65,46 +107,109 @@ class GridSearch(object):
     
     def __str__(self):
         return self.__repr__()
+
+    def save_shared_data(self, shared_dir, X, y):
+        # Writes the data, folds and distance matrices that the tasks read.
+        # The distances do not depend on the parameters so they are only
+        # computed once per fold rather than once per task. Returns the
+        # number of folds.
+        def save(name, arr):
+            np.save(os.path.join(shared_dir, name + '.npy'), arr)
+
+        save('X', X)
+        save('y', y)
+        if self.cv == GridSearch.CV_LOO:
+            if self.share_dists:
+                save('dists', np.float32(cdist(X, X)))
+            return 1
+        for i, (train_idx, test_idx) in enumerate(self.kf.split(X)):
+            save('train_idx_{}'.format(i), train_idx)
+            save('test_idx_{}'.format(i), test_idx)
+            if self.share_dists:
+                save('train_dists_{}'.format(i),
+                     np.float32(cdist(X[train_idx], X[train_idx])))
+                if predict_takes_dists(self.estimator_cls):
+                    save('test_dists_{}'.format(i),
+                         np.float32(cdist(X[train_idx], X[test_idx])))
+        return self.kf.get_n_splits()
     
     def fit(self, X, y):
-        #import traceback
-        from fabric.api import local
-
         X, y = check_X_y(X, y, allow_nd=True, multi_output=True,
                          y_numeric=True, estimator="GridSearch")
         print "njobs = {}".format(self.njobs)
-        if self.njobs > 1:
-            assert False
-#             iterable = [(i, pg, self.estimator_cls, self.kf, X, y, \
-#                          self.score_fns, len(self.parameter_grid)) \
-#                          for i,pg in enumerate(self.parameter_grid)]
-#             try:
-#                 p = multiprocessing.Pool(self.njobs)
-#                 res = p.map(mp_grid_search, iterable)
-#                 print res
-#             except:
-#                 traceback.print_exc()
-        else:
-            self.grid_scores = []
-            estimator = self.estimator_cls()
-            num_tasks = len(self.parameter_grid)
-            for i,params in enumerate(self.parameter_grid):
-                print "Starting task {}/{}...".format(i+1, num_tasks)
-                with stopwatch("Done. Elapsed time"):
-                    self.grid_scores.append(mp_grid_search((i,
-                                                           params,
-                                                           estimator,
-                                                           self.kf,
-                                                           X,
-                                                           y,
-                                                           self.score_fns,
-                                                           len(self.parameter_grid))))
-
-                if self.checkpoint_path is not None:
-                    local("rm -f {}*.p".format(self.checkpoint_path))
-                    savepath = self.checkpoint_path + "_{}.p".format(i)
-                    with open(savepath, 'w') as f:
-                        pickle.dump(self.grid_scores, f)
+        parameter_grid = list(self.parameter_grid)
+        num_params = len(parameter_grid)
+        num_scores = len(self.score_fns)
+        self.grid_scores = [None] * num_params
+
+        # The distances are computed with scipy rather than by the
+        # estimator so that the parent does not need a TF session
+        shared_dir = tempfile.mkdtemp()
+        pool = None
+        checkpoint = None
+        try:
+            nfolds = self.save_shared_data(shared_dir, X, y)
+            tasks = [(i, j, params, self.estimator_cls, self.cv,
+                      self.share_dists, shared_dir, self.score_fns)
+                     for i, params in enumerate(parameter_grid)
+                     for j in range(nfolds)]
+            if self.njobs > 1:
+                # TF sessions are not fork-safe and the pooled ones (and
+                # their threads) stay alive after a GPR is used, so they
+                # are closed before forking. The workers build their own.
+                SESSION_POOL.close()
+                pool = Pool(self.njobs)
+                results = pool.imap_unordered(grid_search_task, tasks)
+            else:
+                results = (grid_search_task(task) for task in tasks)
+
+            if self.checkpoint_path is not None:
+                checkpoint = open(self.checkpoint_path + self.CHECKPOINT_EXT,
+                                  'wb')
+            scores = np.empty((num_params, nfolds, num_scores))
+            folds_left = [nfolds] * num_params
+            with stopwatch("Done. Elapsed time"):
+                for param_idx, fold_idx, task_scores in results:
+                    scores[param_idx, fold_idx] = task_scores
+                    folds_left[param_idx] -= 1
+                    if folds_left[param_idx] > 0:
+                        continue
+                    sparams = self.estimator_cls().set_params(
+                        **parameter_grid[param_idx]).get_params()
+                    grid_score = GridScore(sparams,
+                                           scores[param_idx].mean(axis=0),
+                                           scores[param_idx].copy())
+                    self.grid_scores[param_idx] = grid_score
+                    print "Completed {}/{} parameter settings".format(
+                        folds_left.count(0), num_params)
+                    if checkpoint is not None:
+                        # Each finished setting is appended to the
+                        # checkpoint (see load_checkpoint)
+                        pickle.dump((param_idx, grid_score), checkpoint,
+                                    pickle.HIGHEST_PROTOCOL)
+                        checkpoint.flush()
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+            if pool is not None:
+                # The workers are idle unless a task failed
+                pool.terminate()
+                pool.join()
+            shutil.rmtree(shared_dir)
+
+    @staticmethod
+    def load_checkpoint(checkpoint_path):
+        # Returns {parameter setting index: GridScore} for the settings that
+        # finished before the checkpoint was last written
+        grid_scores = {}
+        with open(checkpoint_path + GridSearch.CHECKPOINT_EXT, 'rb') as f:
+            while True:
+                try:
+                    param_idx, grid_score = pickle.load(f)
+                except EOFError:
+                    break
+                grid_scores[param_idx] = grid_score
+        return grid_scores
 
     @staticmethod
     def create_parameter_grid(param_dict):
@@ -5,7 +5,15 @@ Created on Aug 18, 2016
 '''
 
 import numpy as np
+import os
 import tensorflow as tf
+from collections import OrderedDict
+from contextlib import contextmanager
+from numpy.linalg import LinAlgError
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+from scipy.optimize import minimize
+from threading import Lock, current_thread
+from time import time
 
 
 class GPRResult(object):
@@ -17,33 +25,174 @@ class GPRResult(object):
 class GPR_GDResult(GPRResult):
     
     def __init__(self, ypreds=None, sigmas=None,
-                 minL=None, minL_conf=None):
+                 minL=None, minL_conf=None, n_iters=None):
         super(GPR_GDResult, self).__init__(ypreds, sigmas)
         self.minL = minL
         self.minL_conf = minL_conf
+        self.n_iters = n_iters
+
+class PooledSession(object):
+
+    def __init__(self, graph, vars, ops, sess):
+        self.graph = graph
+        self.vars = vars
+        self.ops = ops
+        self.sess = sess
+        # Identifies the fitted model whose data is currently loaded into
+        # the graph's variables (if any)
+        self.owner = None
+        # Number of callers currently using the session
+        self.refs = 0
+
+    def close(self):
+        self.sess.close()
+        self.sess = None
+        self.owner = None
+
+
+class SessionPool(object):
+
+    DEFAULT_MAX_SIZE = 4
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        assert max_size > 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.entries_ = OrderedDict()
+        self.lock_ = Lock()
+
+    def get(self, key, build_fn):
+        # Returns the pooled graph/session for this key, building it with
+        # build_fn() on a miss, and pins it until it is released. Entries
+        # are kept in LRU order and when the pool is full the least
+        # recently used idle one is closed. Pinned entries are never
+        # closed so the pool grows past max_size if they are all in use.
+        # A session without variables can be shared by several threads
+        # (session.run is thread-safe); sessions with variables must not be
+        # (see GPR_GD.gd_graph_key).
+        with self.lock_:
+            entry = self._pin(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Building the graph is slow so it is done without the lock, which
+        # lets other threads use the sessions that are already pooled. Each
+        # session owns its threads so that closing the pool stops all of
+        # them (see GridSearch.fit).
+        graph, vars, ops = build_fn()
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(
+            intra_op_parallelism_threads=GPR.NUM_THREADS,
+            use_per_session_threads=True))
+        new_entry = PooledSession(graph, vars, ops, sess)
+
+        with self.lock_:
+            entry = self._pin(key)
+            if entry is None:
+                self._evict(self.max_size - 1)
+                new_entry.refs += 1
+                self.entries_[key] = new_entry
+                return new_entry
+        # Another thread built the same graph in the meantime
+        new_entry.close()
+        return entry
+
+    def release(self, entry):
+        with self.lock_:
+            assert entry.refs > 0
+            entry.refs -= 1
+            self._evict(self.max_size)
+
+    @contextmanager
+    def session(self, key, build_fn):
+        entry = self.get(key, build_fn)
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def _pin(self, key):
+        # Returns the entry for key (if any) pinned and moved to the end of
+        # the LRU order. Must be called with the lock held.
+        entry = self.entries_.pop(key, None)
+        if entry is not None:
+            entry.refs += 1
+            self.entries_[key] = entry
+        return entry
+
+    def _evict(self, size):
+        # Closes idle entries (least recently used first) until at most
+        # size entries are left. Must be called with the lock held.
+        for key in [k for k, e in self.entries_.iteritems() if e.refs == 0]:
+            if len(self.entries_) <= size:
+                break
+            self.entries_.pop(key).close()
+
+    def close(self):
+        with self.lock_:
+            for entry in self.entries_.values():
+                entry.close()
+            self.entries_.clear()
+
+    def __len__(self):
+        return len(self.entries_)
+
+
+SESSION_POOL = SessionPool()
+
 
 class GPR(object):
     
     MAX_TRAIN_SIZE = 7000
     BATCH_SIZE = 3000
+    DIST_BATCH_SIZE = 1000
+    # Intra-op threads of each pooled session (see SessionPool.get)
     NUM_THREADS = 4
+    CHOLESKY_JITTER = 1e-6
+    MAX_CHOLESKY_TRIES = 6
+    MIN_VARIANCE = 1e-12
+
+    SOLVER_CHOLESKY = "cholesky"
+    SOLVER_INVERSE = "inverse"
+
+    MODEL_PARAMS_FILE = "params.npz"
+
+    # Whether predict accepts the precomputed distances between the
+    # training rows and the test rows (X_dists)
+    PREDICT_X_DISTS = True
+
+    # Bounds of the length scale, magnitude and ridge multiplier searched by
+    # fit_hyperparameters, which fits them on at most HP_MAX_SAMPLES rows
+    HP_BOUNDS = ((1e-2, 1e3), (1e-2, 1e3), (1e-3, 1e3))
+    HP_MAX_ITER = 50
+    HP_MAX_SAMPLES = 2000
     
     def __init__(self, length_scale=1.0, magnitude=1.0, check_numerics=True,
-                 debug=False):
+                 debug=False, solver=SOLVER_CHOLESKY):
         assert np.isscalar(length_scale)
         assert np.isscalar(magnitude)
         assert length_scale > 0 and magnitude > 0
+        assert solver in (GPR.SOLVER_CHOLESKY, GPR.SOLVER_INVERSE)
         self.length_scale = length_scale
         self.magnitude = magnitude
         self.check_numerics = check_numerics
         self.debug = debug
+        self.solver = solver
+        self.log_marginal_likelihood_ = None
         self.X_train = None
         self.y_train = None
+        self.ridge_train = None
         self.xy_ = None
         self.K = None
+        self.K_inv = None
+        self.L = None
+        self.jitter = None
         self.graph = None
         self.vars = None
         self.ops = None
+        self.timings = {}
 
     def build_graph(self):
         self.vars = {}
@@ -57,15 +206,25 @@ class GPR(object):
                                    dtype=np.float32,
                                    name='length_scale')
 
-            # Nodes for distance computation
-            v1 = tf.placeholder(tf.float32, name="v1")
-            v2 = tf.placeholder(tf.float32, name="v2")
-            dist_op = tf.sqrt(tf.reduce_sum(tf.pow(tf.subtract(v1, v2), 2), 1), name='dist_op')
+            # Nodes for distance computation. Computes all pairwise
+            # distances between the rows of X1 and X2 at once using
+            # ||x||^2 + ||y||^2 - 2xy^T. This is done in double precision
+            # to limit cancellation error for nearby points.
+            X1 = tf.placeholder(tf.float32, name="X1")
+            X2 = tf.placeholder(tf.float32, name="X2")
+            X1_64 = tf.cast(X1, tf.float64)
+            X2_64 = tf.cast(X2, tf.float64)
+            X1_sq = tf.reduce_sum(tf.square(X1_64), 1, True)
+            X2_sq = tf.reduce_sum(tf.square(X2_64), 1, True)
+            sq_dists = X1_sq + tf.transpose(X2_sq) - \
+                2.0 * tf.matmul(X1_64, X2_64, transpose_b=True)
+            dist_op = tf.cast(tf.sqrt(tf.maximum(sq_dists, 0.0)), tf.float32,
+                              name='dist_op')
             if self.check_numerics:
                 dist_op = tf.check_numerics(dist_op, "dist_op: ")
-            
-            self.vars['v1_h'] = v1
-            self.vars['v2_h'] = v2
+
+            self.vars['X1_h'] = X1
+            self.vars['X2_h'] = X2
             self.ops['dist_op'] = dist_op
             
             # Nodes for kernel computation
@@ -101,24 +260,53 @@ class GPR(object):
             self.vars['yt_h'] = yt_
             self.ops['K_inv_op'] = K_inv_op
             self.ops['xy_op'] = xy_op
+
+            # Nodes for the Cholesky solver: K = LL^T and xy = L^T \ (L \ y)
+            L = tf.placeholder(tf.float32, name='L')
+            chol_op = tf.cholesky(K)
+            if self.check_numerics:
+                chol_op = tf.check_numerics(chol_op, "L: ")
+            xy_chol_op = tf.matrix_triangular_solve(
+                L, tf.matrix_triangular_solve(L, yt_, lower=True),
+                lower=True, adjoint=True)
+            if self.check_numerics:
+                xy_chol_op = tf.check_numerics(xy_chol_op, "xy_: ")
+
+            self.vars['L_h'] = L
+            self.ops['chol_op'] = chol_op
+            self.ops['xy_chol_op'] = xy_chol_op
     
-            # Nodes for yhat/sigma computation
+            # Nodes for yhat/sigma computation. Only the diagonal of the
+            # predictive covariance is needed: the kernel diagonal is just
+            # the magnitude and diag(K2^T K^-1 K2) is reduced row-wise, so
+            # the test x test kernel matrix is never materialized.
             K2 = tf.placeholder(tf.float32, name="K2")
-            K3 = tf.placeholder(tf.float32, name="K3")
             yhat_ =  tf.cast(tf.matmul( tf.transpose(K2), xy_), tf.float32);
             if self.check_numerics:
                 yhat_ = tf.check_numerics(yhat_, "yhat_: ")
-            sv1 = tf.matmul(tf.transpose(K2), tf.matmul(K_inv, K2))
+            sv1 = tf.reduce_sum(K2 * tf.matmul(K_inv, K2), 0)
             if self.check_numerics:
                 sv1 = tf.check_numerics(sv1, "sv1: ")
-            sig_val = tf.cast((tf.sqrt(tf.diag_part(K3 - sv1))), tf.float32)
+            sig_val = tf.cast(tf.sqrt(tf.maximum(mag_const - sv1,
+                                                 self.MIN_VARIANCE)), tf.float32)
             if self.check_numerics:
                 sig_val = tf.check_numerics(sig_val, "sig_val: ")
 
+            # With the Cholesky solver diag(K2^T K^-1 K2) = sum(v^2) where
+            # v = L \ K2
+            v = tf.matrix_triangular_solve(L, K2, lower=True)
+            sv1_chol = tf.reduce_sum(tf.square(v), 0)
+            if self.check_numerics:
+                sv1_chol = tf.check_numerics(sv1_chol, "sv1: ")
+            sig_chol_val = tf.cast(tf.sqrt(tf.maximum(mag_const - sv1_chol,
+                                                      self.MIN_VARIANCE)), tf.float32)
+            if self.check_numerics:
+                sig_chol_val = tf.check_numerics(sig_chol_val, "sig_val: ")
+
             self.vars['K2_h'] = K2
-            self.vars['K3_h'] = K3
             self.ops['yhat_op'] = yhat_
             self.ops['sig_op'] = sig_val
+            self.ops['sig_chol_op'] = sig_chol_val
             
             # Compute y_best (min y)
             y_best_op = tf.cast(tf.reduce_min(yt_, 0, True), tf.float32)
@@ -153,7 +341,7 @@ class GPR(object):
     
     def check_fitted(self):
         if self.X_train is None or self.y_train is None \
-                or self.xy_ is None or self.K is None:
+                or self.xy_ is None or (self.K_inv is None and self.L is None):
             raise Exception("The model must be trained before making predictions!")
         
     def check_array(self, X):
@@ -166,96 +354,386 @@ class GPR(object):
             raise Exception("Input contains non-finite values: {}"
                             .format(X[~finite_els]))
     
-    def fit(self, X_train, y_train, ridge=1.0):
+    def compute_dists(self, sess, X1, X2):
+        # Computes the pairwise distances between the rows of X1 and X2.
+        # X1 is processed in tiles of DIST_BATCH_SIZE rows to bound the
+        # size of the intermediate matrices.
+        dist_op = self.ops['dist_op']
+        X1_ph, X2_ph = self.vars['X1_h'], self.vars['X2_h']
+        n_rows = X1.shape[0]
+        dists = np.empty((n_rows, X2.shape[0]), dtype=np.float32)
+        for start in range(0, n_rows, self.DIST_BATCH_SIZE):
+            end = min(start + self.DIST_BATCH_SIZE, n_rows)
+            dists[start:end] = sess.run(dist_op, feed_dict={X1_ph:X1[start:end],
+                                                            X2_ph:X2})
+        return dists
+
+    def compute_kernel(self, sess, X1, X2):
+        # Kernel matrix between the rows of X1 and X2 (without the ridge) in
+        # double precision
+        dists = self.compute_dists(sess, X1, X2)
+        return np.float64(sess.run(self.ops['K_op'],
+                                   feed_dict={self.vars['X_dists_h']:dists}))
+
+    def factorize(self, sess, K):
+        # Computes the Cholesky factor of K. If K is not positive definite
+        # (e.g. due to round-off error) then increasing amounts of jitter are
+        # added to the diagonal until the factorization succeeds.
+        chol_op = self.ops['chol_op']
+        K_ph = self.vars['K_h']
+        base_jitter = self.CHOLESKY_JITTER * np.mean(np.diag(K))
+        jitter = 0.0
+        for _ in range(self.MAX_CHOLESKY_TRIES):
+            try:
+                K_jitter = K if jitter == 0.0 else \
+                    K + np.float32(jitter) * np.eye(K.shape[0], dtype=np.float32)
+                return sess.run(chol_op, feed_dict={K_ph:K_jitter}), jitter
+            except tf.errors.InvalidArgumentError:
+                jitter = base_jitter if jitter == 0.0 else jitter * 10
+                if self.debug is True:
+                    print "Cholesky failed, retrying with jitter={}".format(jitter)
+        raise Exception("Kernel matrix is not positive definite "
+                        "(jitter={})".format(jitter))
+
+    def graph_key(self):
+        # The graph only depends on the hyperparameters, so models that
+        # share them can share a graph/session from the pool
+        return (self.__class__.__name__, self.length_scale,
+                self.magnitude, self.check_numerics)
+
+    @contextmanager
+    def pooled_session(self):
+        # Borrows the pooled session for this model's graph
+        with SESSION_POOL.session(self.graph_key(),
+                                  self._build_pooled_graph) as entry:
+            self.graph, self.vars, self.ops = entry.graph, entry.vars, entry.ops
+            yield entry.sess
+
+    def record_timing(self, call, setup_start, compute_start):
+        # Records the time spent setting up the graph/session vs. the time
+        # spent on the actual computation for the most recent call
+        self.timings[call] = {
+            'setup': compute_start - setup_start,
+            'compute': time() - compute_start,
+        }
+
+    def _build_pooled_graph(self):
+        self.build_graph()
+        return self.graph, self.vars, self.ops
+
+    def fit(self, X_train, y_train, ridge=1.0, X_dists=None):
+        # X_dists optionally holds the precomputed pairwise distances
+        # between the rows of X_train (they do not depend on the
+        # hyperparameters, so they can be shared by several models)
+        setup_start = time()
         self._reset()
         X_train, y_train = self.check_X_y(X_train, y_train)
+        if y_train.ndim == 1:
+            y_train = y_train.reshape(-1, 1)
+        # Each column of y_train is a separate output. All outputs share the
+        # same kernel so it is only factorized once.
         self.X_train = np.float32(X_train)
         self.y_train = np.float32(y_train)
         sample_size = self.X_train.shape[0]
-        
+
         if np.isscalar(ridge):
             ridge = np.ones(sample_size) * ridge
         assert ridge.ndim == 1
+        self.ridge_train = np.float32(ridge)
+
+        with self.pooled_session() as sess:
+            compute_start = time()
+            if X_dists is None:
+                X_dists = self.compute_dists(sess, self.X_train, self.X_train)
+            else:
+                assert X_dists.shape == (sample_size, sample_size)
+                X_dists = np.float32(X_dists)
 
-        X_dists = np.zeros((sample_size, sample_size), dtype=np.float32)
-        with tf.Session(graph=self.graph, config=tf.ConfigProto(
-                intra_op_parallelism_threads=self.NUM_THREADS)) as sess:
-            dist_op = self.ops['dist_op']
-            v1, v2 = self.vars['v1_h'], self.vars['v2_h']
-            for i in range(sample_size):
-                X_dists[i] = sess.run(dist_op, feed_dict={v1:self.X_train[i], v2:self.X_train})
-        
             K_ridge_op = self.ops['K_ridge_op']
             X_dists_ph = self.vars['X_dists_h']
             ridge_ph = self.vars['ridge_h']
 
-            self.K = sess.run(K_ridge_op, feed_dict={X_dists_ph:X_dists, ridge_ph:ridge})
-            
-            K_ph = self.vars['K_h']
-            
-            K_inv_op = self.ops['K_inv_op']
-            self.K_inv = sess.run(K_inv_op, feed_dict={K_ph:self.K})
-
-            xy_op = self.ops['xy_op']
-            K_inv_ph = self.vars['K_inv_h']
+            K = sess.run(K_ridge_op, feed_dict={X_dists_ph:X_dists, ridge_ph:ridge})
             yt_ph = self.vars['yt_h']
-            self.xy_ = sess.run(xy_op, feed_dict={K_inv_ph:self.K_inv,
-                                                  yt_ph:self.y_train})
 
+            if self.solver == GPR.SOLVER_CHOLESKY:
+                # Only the factor is kept since K is never needed again
+                self.L, self.jitter = self.factorize(sess, K)
+                xy_op = self.ops['xy_chol_op']
+                L_ph = self.vars['L_h']
+                self.xy_ = sess.run(xy_op, feed_dict={L_ph:self.L,
+                                                      yt_ph:self.y_train})
+            else:
+                self.K = K
+                K_ph = self.vars['K_h']
+
+                K_inv_op = self.ops['K_inv_op']
+                self.K_inv = sess.run(K_inv_op, feed_dict={K_ph:self.K})
+
+                xy_op = self.ops['xy_op']
+                K_inv_ph = self.vars['K_inv_h']
+                self.xy_ = sess.run(xy_op, feed_dict={K_inv_ph:self.K_inv,
+                                                      yt_ph:self.y_train})
+
+        self.record_timing('fit', setup_start, compute_start)
         return self
+
+    def check_updatable(self):
+        self.check_fitted()
+        if self.solver != GPR.SOLVER_CHOLESKY:
+            raise Exception("Only models fit with the Cholesky solver can be "
+                            "updated (solver={})".format(self.solver))
+
+    def append(self, X_new, y_new, ridge=1.0):
+        # Adds rows to the training data of a fitted model by extending the
+        # Cholesky factor of K, which takes O(n^2) time per new row instead
+        # of the O(n^3) time of refitting. The result is the same as
+        # refitting on all of the rows (up to round-off).
+        self.check_updatable()
+        X_new, y_new = self.check_X_y(X_new, y_new)
+        if y_new.ndim == 1:
+            y_new = y_new.reshape(-1, 1)
+        if y_new.shape[1] != self.y_train.shape[1]:
+            raise Exception("Expected {} outputs but got {}".format(
+                self.y_train.shape[1], y_new.shape[1]))
+        X_new = np.float32(X_new)
+        n_train = self.X_train.shape[0]
+        n_new = X_new.shape[0]
+        if n_train + n_new > GPR.MAX_TRAIN_SIZE:
+            raise Exception("X_train size cannot exceed {} ({})"
+                            .format(GPR.MAX_TRAIN_SIZE, n_train + n_new))
+        if np.isscalar(ridge):
+            ridge = np.ones(n_new) * ridge
+        assert ridge.ndim == 1
+
+        # With K = [K11 K12; K21 K22] the factor is [L11 0; L21 L22] where
+        # L21 = (L11 \ K12)^T and L22 L22^T = K22 - L21 L21^T
+        with self.pooled_session() as sess:
+            L11 = np.float64(self.L)
+            K12 = self.compute_kernel(sess, self.X_train, X_new)
+            K22 = self.compute_kernel(sess, X_new, X_new) + np.diag(ridge + self.jitter)
+        L21 = solve_triangular(L11, K12, lower=True).T
+        try:
+            L22 = cholesky(K22 - np.dot(L21, L21.T), lower=True)
+        except LinAlgError:
+            raise Exception("Kernel matrix is not positive definite after "
+                            "appending {} rows; refit the model".format(n_new))
+        L = np.zeros((n_train + n_new, n_train + n_new))
+        L[:n_train, :n_train] = L11
+        L[n_train:, :n_train] = L21
+        L[n_train:, n_train:] = L22
+
+        self.X_train = np.vstack([self.X_train, X_new])
+        self.y_train = np.vstack([self.y_train, np.float32(y_new)])
+        self.ridge_train = np.concatenate([self.ridge_train, np.float32(ridge)])
+        self.update_weights(L)
+        return self
+
+    def remove(self, idxs):
+        # Removes the training rows at idxs from a fitted model. Removing
+        # row i only changes the part of the factor below it, which is
+        # fixed with a rank-one update in O((n - i)^2) time.
+        self.check_updatable()
+        n_train = self.X_train.shape[0]
+        idxs = np.unique(np.asarray(idxs, dtype=int))
+        if idxs.size == 0:
+            return self
+        if idxs[0] < 0 or idxs[-1] >= n_train:
+            raise Exception("Row indices must be in [0, {})".format(n_train))
+        if idxs.size == n_train:
+            raise Exception("Cannot remove all of the training rows")
+
+        L = np.float64(self.L)
+        for i in idxs[::-1]:
+            l_below = L[i + 1:, i].copy()
+            L = np.delete(np.delete(L, i, 0), i, 1)
+            if l_below.size > 0:
+                self.cholesky_update(L[i:, i:], l_below)
+
+        keep = np.ones(n_train, dtype=bool)
+        keep[idxs] = False
+        self.X_train = self.X_train[keep]
+        self.y_train = self.y_train[keep]
+        self.ridge_train = self.ridge_train[keep]
+        self.update_weights(L)
+        return self
+
+    @staticmethod
+    def cholesky_update(L, x):
+        # Updates the lower triangular factor L in place so that
+        # L L^T becomes L L^T + x x^T
+        x = np.array(x, dtype=np.float64)
+        for k in range(L.shape[0]):
+            r = np.hypot(L[k, k], x[k])
+            c = r / L[k, k]
+            s = x[k] / L[k, k]
+            L[k, k] = r
+            L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+            x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+        return L
+
+    def loo_predict(self):
+        # Returns the leave-one-out predictions of the training rows (each
+        # row predicted by the model fit on all of the other rows). They
+        # follow in closed form from K^-1:
+        #   ypred_i = y_i - [K^-1 y]_i / [K^-1]_ii
+        #   sigma_i^2 = 1 / [K^-1]_ii - ridge_i
+        # so no refitting is needed. Like those returned by predict, the
+        # sigmas exclude the noise.
+        self.check_fitted()
+        if self.ridge_train is None:
+            raise Exception("The ridge of the training rows is unknown")
+        y_train = np.float64(self.y_train)
+        if self.solver == GPR.SOLVER_CHOLESKY:
+            L = np.float64(self.L)
+            L_inv = solve_triangular(L, np.eye(L.shape[0]), lower=True)
+            K_inv_diag = np.sum(np.square(L_inv), 0)
+            alpha = cho_solve((L, True), y_train)
+        else:
+            K_inv = np.float64(self.K_inv)
+            K_inv_diag = np.diag(K_inv)
+            alpha = np.dot(K_inv, y_train)
+        K_inv_diag = K_inv_diag.reshape(-1, 1)
+        noise = np.float64(self.ridge_train).reshape(-1, 1)
+        if self.jitter is not None:
+            noise += self.jitter
+        ypreds = y_train - alpha / K_inv_diag
+        sigmas = np.sqrt(np.maximum(1.0 / K_inv_diag - noise,
+                                    self.MIN_VARIANCE))
+        return GPRResult(ypreds, sigmas)
+
+    def update_weights(self, L):
+        self.L = np.float32(L)
+        self.xy_ = np.float32(cho_solve((L, True), np.float64(self.y_train)))
+
+    @staticmethod
+    def log_marginal_likelihood(dists, y, ridge, length_scale, magnitude,
+                                eval_gradient=False):
+        # Returns the log marginal likelihood of y (one column per output)
+        # given the pairwise distances between the training rows. Its
+        # gradient is wrt log(length_scale), log(magnitude) and the log of
+        # a multiplier of ridge.
+        K_f = magnitude * np.exp(-dists / length_scale)
+        try:
+            L = cholesky(K_f + np.diag(ridge), lower=True)
+        except LinAlgError:
+            return (-np.inf, np.zeros(3)) if eval_gradient else -np.inf
+        n_samples, n_outputs = y.shape
+        alpha = cho_solve((L, True), y)
+        lml = -0.5 * np.sum(y * alpha) - \
+            n_outputs * np.sum(np.log(np.diag(L))) - \
+            0.5 * n_samples * n_outputs * np.log(2 * np.pi)
+        if not eval_gradient:
+            return lml
+
+        # d(lml)/d(theta) = 0.5 * tr(W dK/d(theta)) where
+        # W = alpha alpha^T - n_outputs * K^-1
+        W = np.dot(alpha, alpha.T) - \
+            n_outputs * cho_solve((L, True), np.eye(n_samples))
+        grad = 0.5 * np.array([np.sum(W * K_f * dists) / length_scale,
+                               np.sum(W * K_f),
+                               np.sum(np.diag(W) * ridge)])
+        return lml, grad
+
+    def fit_hyperparameters(self, X_train, y_train, ridge=1.0,
+                            max_iter=HP_MAX_ITER):
+        # Sets length_scale and magnitude to the values that maximize the
+        # log marginal likelihood of the training data, along with a
+        # multiplier of ridge (so the relative noise of the rows is kept).
+        # The distances are only computed once and each step of L-BFGS
+        # costs a single factorization. Returns the scaled ridge to pass
+        # to fit.
+        X_train, y_train = self.check_X_y(X_train, y_train)
+        if y_train.ndim == 1:
+            y_train = y_train.reshape(-1, 1)
+        sample_size = X_train.shape[0]
+        if np.isscalar(ridge):
+            ridge = np.ones(sample_size) * ridge
+        assert ridge.ndim == 1
+
+        idxs = np.arange(sample_size)
+        if sample_size > self.HP_MAX_SAMPLES:
+            idxs = np.sort(np.random.choice(sample_size, self.HP_MAX_SAMPLES,
+                                            replace=False))
+        X_hp = np.float32(X_train[idxs])
+        y_hp = np.float64(y_train[idxs])
+        with self.pooled_session() as sess:
+            dists = np.float64(self.compute_dists(sess, X_hp, X_hp))
+
+        def objective(theta):
+            length_scale, magnitude, multiplier = np.exp(theta)
+            lml, grad = self.log_marginal_likelihood(
+                dists, y_hp, ridge[idxs] * multiplier, length_scale,
+                magnitude, eval_gradient=True)
+            return -lml, -grad
+
+        theta0 = np.log([self.length_scale, self.magnitude, 1.0])
+        bounds = np.log(self.HP_BOUNDS)
+        res = minimize(objective, theta0, jac=True, method='L-BFGS-B',
+                       bounds=bounds, options={'maxiter': max_iter})
+        if self.debug is True:
+            print "Hyperparameter fit: {} ({} iterations)".format(
+                res.message, res.nit)
+        length_scale, magnitude, multiplier = np.exp(res.x)
+        self.length_scale = float(length_scale)
+        self.magnitude = float(magnitude)
+        self.log_marginal_likelihood_ = -res.fun
+        return ridge * multiplier
     
-    def predict(self, X_test):
+    def predict(self, X_test, X_dists=None):
+        # X_dists optionally holds the precomputed distances between the
+        # training rows and the rows of X_test ([n_train, n_test])
+        setup_start = time()
         self.check_fitted()
         X_test = np.float32(self.check_array(X_test))
         test_size = X_test.shape[0]
-        sample_size = self.X_train.shape[0]
+        if X_dists is not None:
+            assert X_dists.shape == (self.X_train.shape[0], test_size)
+        n_outputs = self.xy_.shape[1]
 
+        # The predictive variance does not depend on y so sigma is shared
+        # by all outputs
         arr_offset = 0
-        yhats = np.zeros([test_size, 1])
+        yhats = np.zeros([test_size, n_outputs])
         sigmas = np.zeros([test_size, 1])
-        #with tf.Session(graph=self.graph) as sess:
-        with tf.Session(graph=self.graph, config=tf.ConfigProto(
-                intra_op_parallelism_threads=self.NUM_THREADS)) as sess:
-            # Nodes for distance operation
-            dist_op = self.ops['dist_op']
-            v1 = self.vars['v1_h']
-            v2 = self.vars['v2_h']
-            
+        with self.pooled_session() as sess:
+
             # Nodes for kernel computation
             K_op = self.ops['K_op']
-            X_dists = self.vars['X_dists_h']
-            
+            X_dists_ph = self.vars['X_dists_h']
+
             # Nodes to compute yhats/sigmas
             yhat_ = self.ops['yhat_op']
-            K_inv_ph = self.vars['K_inv_h']
             K2 = self.vars['K2_h']
-            K3 = self.vars['K3_h']
             xy_ph = self.vars['xy_h']
+            if self.solver == GPR.SOLVER_CHOLESKY:
+                sig_val = self.ops['sig_chol_op']
+                factor_feed = {self.vars['L_h']:self.L}
+            else:
+                sig_val = self.ops['sig_op']
+                factor_feed = {self.vars['K_inv_h']:self.K_inv}
 
+            compute_start = time()
             while arr_offset < test_size:
                 if arr_offset + GPR.BATCH_SIZE > test_size:
                     end_offset = test_size
                 else:
                     end_offset = arr_offset + GPR.BATCH_SIZE;
-    
+
                 X_test_batch = X_test[arr_offset:end_offset];
                 batch_len = end_offset - arr_offset
-        
-                dists1 = np.zeros([sample_size,batch_len])
-                for i in range(sample_size):
-                    dists1[i] = sess.run(dist_op, feed_dict={v1:self.X_train[i],
-                                                             v2:X_test_batch})
 
-                sig_val = self.ops['sig_op']
-                K2_ = sess.run(K_op, feed_dict={X_dists:dists1})
-                yhat = sess.run(yhat_, feed_dict={K2:K2_, xy_ph:self.xy_})
-                dists2 = np.zeros([batch_len,batch_len])
-                for i in range(batch_len):
-                    dists2[i] = sess.run(dist_op, feed_dict={v1:X_test_batch[i], v2:X_test_batch})
-                K3_ = sess.run(K_op, feed_dict={X_dists:dists2})
-        
+                if X_dists is None:
+                    dists1 = self.compute_dists(sess, self.X_train, X_test_batch)
+                else:
+                    dists1 = np.float32(X_dists[:, arr_offset:end_offset])
+
+                K2_ = sess.run(K_op, feed_dict={X_dists_ph:dists1})
+
                 sigma = np.zeros([1,batch_len], np.float32)
-                sigma[0] = sess.run(sig_val,feed_dict={K_inv_ph:self.K_inv, K2:K2_, K3:K3_})
+                feed_dict = {K2:K2_, xy_ph:self.xy_}
+                feed_dict.update(factor_feed)
+                yhat, sigma[0] = sess.run([yhat_, sig_val], feed_dict=feed_dict)
                 sigma = np.transpose(sigma)
                 yhats[arr_offset:end_offset] = yhat
                 sigmas[arr_offset:end_offset] =  sigma
@@ -263,6 +741,7 @@ class GPR(object):
 
         self.check_output(yhats)
         self.check_output(sigmas)
+        self.record_timing('predict', setup_start, compute_start)
         return GPRResult(yhats, sigmas)
     
     def get_params(self, deep=True):
@@ -272,24 +751,79 @@ class GPR(object):
                 "y_train": self.y_train,
                 "xy_": self.xy_,
                 "K": self.K,
-                "K_inv": self.K_inv}
+                "K_inv": self.K_inv,
+                "L": self.L,
+                "solver": self.solver}
     
     def set_params(self, **parameters):
         for param, val in parameters.iteritems():
             setattr(self, param, val)
         return self
 
-    def _reset(self):
-        import gc
+    def save_model(self, path):
+        # Saves the fitted model to the directory at path. Each array is
+        # written as an uncompressed .npy file so that load_model can
+        # memory-map it instead of reading it into memory.
+        self.check_fitted()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        arrays = {
+            'X_train': self.X_train,
+            'y_train': self.y_train,
+            'xy_': self.xy_,
+        }
+        if self.ridge_train is not None:
+            arrays['ridge_train'] = self.ridge_train
+        if self.solver == GPR.SOLVER_CHOLESKY:
+            arrays['L'] = self.L
+        else:
+            arrays['K_inv'] = self.K_inv
+        for name, arr in arrays.iteritems():
+            np.save(os.path.join(path, name + '.npy'), arr)
+        np.savez(os.path.join(path, self.MODEL_PARAMS_FILE),
+                 length_scale=self.length_scale,
+                 magnitude=self.magnitude,
+                 check_numerics=self.check_numerics,
+                 solver=self.solver,
+                 jitter=self.jitter if self.jitter is not None else 0.0)
+        return path
+
+    @classmethod
+    def load_model(cls, path, mmap_mode='r'):
+        # Loads a model saved by save_model. The model can be used for
+        # predictions right away without being refit.
+        params = np.load(os.path.join(path, cls.MODEL_PARAMS_FILE))
+        model = cls(length_scale=float(params['length_scale']),
+                    magnitude=float(params['magnitude']),
+                    solver=str(params['solver']))
+        model.check_numerics = bool(params['check_numerics'])
+        model.jitter = float(params['jitter'])
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'),
+                           mmap_mode=mmap_mode)
 
+        model.X_train = load('X_train')
+        model.y_train = load('y_train')
+        model.xy_ = load('xy_')
+        if os.path.exists(os.path.join(path, 'ridge_train.npy')):
+            model.ridge_train = load('ridge_train')
+        if model.solver == GPR.SOLVER_CHOLESKY:
+            model.L = load('L')
+        else:
+            model.K_inv = load('K_inv')
+        return model
+
+    def _reset(self):
         self.X_train = None
         self.y_train = None
+        self.ridge_train = None
         self.xy_ = None
         self.K = None
         self.K_inv = None
-        self.graph = None
-        self.build_graph()
-        gc.collect()
+        self.L = None
+        self.jitter = None
+        self.timings = {}
 
 class GPR_GD(GPR):
 
@@ -302,9 +836,17 @@ class GPR_GD(GPR):
     DEFAULT_RIDGE = 1.0
     DEFAULT_SIGMA_MULTIPLIER = 3.0
     DEFAULT_MU_MULTIPLIER = 1.0
+    DEFAULT_LOSS_TOL = 1e-6
+    DEFAULT_GRAD_TOL = 1e-5
+    DEFAULT_PATIENCE = 10
+    MIN_SQ_DIST = 1e-12
     
     GP_BETA_UCB = "UCB"
     GP_BETA_CONST = "CONST"
+
+    # The starting configurations move during gradient descent so their
+    # initial distances to the training rows are of no use
+    PREDICT_X_DISTS = False
     
     def __init__(self, length_scale=DEFAULT_LENGTH_SCALE,
                  magnitude=DEFAULT_MAGNITUDE,
@@ -312,66 +854,214 @@ class GPR_GD(GPR):
                  epsilon=DEFAULT_EPSILON,
                  max_iter=DEFAULT_MAX_ITER,
                  sigma_multiplier=DEFAULT_SIGMA_MULTIPLIER,
-                 mu_multiplier=DEFAULT_MU_MULTIPLIER):
-        super(GPR_GD, self).__init__(length_scale, magnitude)
+                 mu_multiplier=DEFAULT_MU_MULTIPLIER,
+                 solver=GPR.SOLVER_CHOLESKY,
+                 loss_tol=DEFAULT_LOSS_TOL,
+                 grad_tol=DEFAULT_GRAD_TOL,
+                 patience=DEFAULT_PATIENCE):
+        super(GPR_GD, self).__init__(length_scale, magnitude, solver=solver)
         self.learning_rate = learning_rate
         self.epsilon = epsilon
         self.max_iter = max_iter
         self.sigma_multiplier = sigma_multiplier
         self.mu_multiplier = mu_multiplier
+        # A start stops early once its gradient norm drops below grad_tol
+        # or its relative loss change stays below loss_tol for patience
+        # consecutive steps. Setting both tolerances to 0 disables it.
+        self.loss_tol = loss_tol
+        self.grad_tol = grad_tol
+        self.patience = patience
+        # Identifies this model's data in the pooled GD sessions. It is
+        # renewed whenever the data changes. A fresh token is needed here
+        # (not None) so that models from load_model load their data too.
+        self.session_token = object()
     
-    def fit(self, X_train, y_train, ridge=DEFAULT_RIDGE):
-        super(GPR_GD, self).fit(X_train, y_train, ridge)
-
-        with tf.Session(graph=self.graph, config=tf.ConfigProto(
-                intra_op_parallelism_threads=self.NUM_THREADS)) as sess:
-            xt_ = tf.Variable(self.X_train[0], tf.float32)
-            xt_ph = tf.placeholder(tf.float32)
-            xt_assign_op = xt_.assign(xt_ph)
+    def build_gd_graph(self, nfeats, batch_size):
+        # Builds the graph that optimizes batch_size starting configurations
+        # at once. Each row of xt_ is an independent start: the loss is a
+        # vector with one entry per start, and Adam's updates are elementwise
+        # so minimizing its sum optimizes every start separately.
+        vars = {}
+        ops = {}
+        graph = tf.Graph()
+        with graph.as_default():
+            # The training data and model weights are stored in variables
+            # so they only need to be loaded into the session once per fit
+            X_train_var = tf.Variable(tf.zeros([0, nfeats]), trainable=False,
+                                      validate_shape=False, name='X_train_var')
+            xy_var = tf.Variable(tf.zeros([0, 1]), trainable=False,
+                                 validate_shape=False, name='xy_var')
+            factor_var = tf.Variable(tf.zeros([0, 0]), trainable=False,
+                                     validate_shape=False, name='factor_var')
+            data_vars = [X_train_var, xy_var, factor_var]
+            data_phs = [tf.placeholder(tf.float32) for _ in data_vars]
+            load_data_ops = [tf.assign(var, ph, validate_shape=False)
+                             for var, ph in zip(data_vars, data_phs)]
+
+            xt_var = tf.Variable(tf.zeros([batch_size, nfeats]), name='xt_')
+            xt_ph = tf.placeholder(tf.float32, shape=[batch_size, nfeats])
+            xt_assign_op = xt_var.assign(xt_ph)
+            xt_ = xt_var
             if self.check_numerics is True:
                 xt_ = tf.check_numerics(xt_, "xt_: ")
-            init = tf.global_variables_initializer()
-            sess.run(init)
-            K2_mat =  tf.transpose(tf.expand_dims(tf.sqrt(tf.reduce_sum(tf.pow(tf.subtract(xt_, self.X_train), 2),1)), 0))
+
+            # Distances between the training data and every start
+            # ([n_train, batch_size]), computed the same way as dist_op. The
+            # squared distances are floored so the gradient of sqrt stays
+            # finite when a start coincides with a training point.
+            X_64 = tf.cast(X_train_var, tf.float64)
+            xt_64 = tf.cast(xt_, tf.float64)
+            sq_dists = tf.reduce_sum(tf.square(X_64), 1, True) + \
+                tf.transpose(tf.reduce_sum(tf.square(xt_64), 1, True)) - \
+                2.0 * tf.matmul(X_64, xt_64, transpose_b=True)
+            K2_mat = tf.cast(tf.sqrt(tf.maximum(sq_dists, self.MIN_SQ_DIST)),
+                             tf.float32)
             if self.check_numerics is True:
                 K2_mat = tf.check_numerics(K2_mat, "K2_mat: ")
-            K2__ = tf.cast(self.magnitude * tf.exp(-K2_mat/self.length_scale),tf.float32)
+            K2__ = self.magnitude * tf.exp(-K2_mat / self.length_scale)
             if self.check_numerics is True:
                 K2__ = tf.check_numerics(K2__, "K2__: ")
-            yhat_gd =  tf.cast(tf.matmul( tf.transpose(K2__) , self.xy_),tf.float32)
+            yhat_gd = tf.reshape(tf.matmul(K2__, xy_var, transpose_a=True),
+                                 [batch_size])
             if self.check_numerics is True:
                 yhat_gd = tf.check_numerics(yhat_gd, message="yhat: ")
-            sig_val = tf.cast((tf.sqrt(self.magnitude -  tf.matmul( tf.transpose(K2__) ,tf.matmul(self.K_inv, K2__)) )),tf.float32)
+            if self.solver == GPR.SOLVER_CHOLESKY:
+                v = tf.matrix_triangular_solve(factor_var, K2__, lower=True)
+                sv1 = tf.reduce_sum(tf.square(v), 0)
+            else:
+                sv1 = tf.reduce_sum(K2__ * tf.matmul(factor_var, K2__), 0)
+            sig_val = tf.sqrt(tf.maximum(self.magnitude - sv1, self.MIN_VARIANCE))
             if self.check_numerics is True:
                 sig_val = tf.check_numerics(sig_val, message="sigma: ")
-#             print ""
-#             print "yhat_gd : {}".format(sess.run(yhat_gd))
-#             print ""
-#             print "sig_val : {}".format(sess.run(sig_val))
 
-            Loss = tf.squeeze(tf.subtract(self.mu_multiplier * yhat_gd, self.sigma_multiplier * sig_val))
+            Loss = tf.subtract(self.mu_multiplier * yhat_gd, self.sigma_multiplier * sig_val)
             if self.check_numerics is True: 
                 Loss = tf.check_numerics(Loss, "loss: ")
+
+            # Per-start convergence state. Once a start is no longer active
+            # its best iterate and iteration count are frozen.
+            active = tf.Variable(tf.ones([batch_size], dtype=tf.bool),
+                                 trainable=False, name='active')
+            prev_loss = tf.Variable(tf.constant(np.inf, tf.float32, [batch_size]),
+                                    trainable=False, name='prev_loss')
+            stall_count = tf.Variable(tf.zeros([batch_size], dtype=tf.int32),
+                                      trainable=False, name='stall_count')
+            n_iters = tf.Variable(tf.zeros([batch_size], dtype=tf.int32),
+                                  trainable=False, name='n_iters')
+            was_active = active.value()
+
+            grad = tf.gradients(tf.reduce_sum(Loss), xt_var)[0]
+            grad_norm = tf.sqrt(tf.reduce_sum(tf.square(grad), 1))
+            prev_loss_val = prev_loss.value()
+            rel_change = tf.abs(Loss - prev_loss_val) / \
+                tf.maximum(tf.abs(prev_loss_val), self.MIN_VARIANCE)
+            stalled = tf.less(rel_change, self.loss_tol)
+            new_stall_count = tf.where(stalled, stall_count.value() + 1,
+                                       tf.zeros_like(stall_count.value()))
+            still_active = tf.logical_and(was_active, tf.logical_and(
+                tf.greater_equal(grad_norm, self.grad_tol),
+                tf.less(new_stall_count, self.patience)))
+            update_conv_op = tf.group(
+                tf.assign(stall_count, tf.where(was_active, new_stall_count,
+                                                stall_count.value())),
+                tf.assign(prev_loss, tf.where(was_active, Loss, prev_loss_val)),
+                tf.assign(n_iters, n_iters.value() + tf.cast(was_active, tf.int32)),
+                tf.assign(active, still_active))
+
+            # Keep track of the iterate with the lowest loss for each start
+            best_loss = tf.Variable(tf.constant(np.inf, tf.float32, [batch_size]),
+                                    trainable=False, name='best_loss')
+            best_yhat = tf.Variable(tf.zeros([batch_size]), trainable=False,
+                                    name='best_yhat')
+            best_sigma = tf.Variable(tf.zeros([batch_size]), trainable=False,
+                                     name='best_sigma')
+            best_conf = tf.Variable(tf.zeros([batch_size, nfeats]),
+                                    trainable=False, name='best_conf')
+            prev_best_loss = best_loss.value()
+            improved = tf.logical_and(was_active, tf.less(Loss, prev_best_loss))
+            update_best_op = tf.group(
+                tf.assign(best_loss, tf.where(improved, Loss, prev_best_loss)),
+                tf.assign(best_yhat, tf.where(improved, yhat_gd, best_yhat.value())),
+                tf.assign(best_sigma, tf.where(improved, sig_val, best_sigma.value())),
+                tf.assign(best_conf, tf.where(improved, xt_, best_conf.value())))
+
             optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
                                                epsilon=self.epsilon)
             #optimizer = tf.train.GradientDescentOptimizer(learning_rate=self.learning_rate)
-            train = optimizer.minimize(Loss)
+            # Each step records the current iterate and checks for
+            # convergence before updating it. Converged rows get a zero
+            # gradient; Adam's momentum may still move them, but their
+            # results are already frozen.
+            with tf.control_dependencies([update_best_op, update_conv_op]):
+                mask = tf.expand_dims(tf.cast(active.read_value(), tf.float32), 1)
+                masked_grad = grad * mask
+                num_active_op = tf.reduce_sum(tf.cast(active.read_value(), tf.int32))
+            train = optimizer.apply_gradients([(masked_grad, xt_var)])
 
-            self.vars['xt_'] = xt_
-            self.vars['xt_ph'] = xt_ph
-            self.ops['xt_assign_op'] = xt_assign_op
-            self.ops['yhat_gd'] = yhat_gd
-            self.ops['sig_val2'] = sig_val
-            self.ops['loss_op'] = Loss
-            self.ops['train_op'] = train
+            # Resets the optimizer state without touching the loaded data
+            data_var_names = set(var.name for var in data_vars)
+            gd_reset_op = tf.variables_initializer(
+                [var for var in tf.global_variables()
+                 if var.name not in data_var_names])
 
+            vars['data_phs'] = data_phs
+            vars['xt_ph'] = xt_ph
+            ops['load_data_ops'] = load_data_ops
+            ops['xt_assign_op'] = xt_assign_op
+            ops['loss_op'] = Loss
+            ops['train_op'] = train
+            ops['update_best_op'] = update_best_op
+            ops['num_active_op'] = num_active_op
+            ops['best_ops'] = [best_yhat, best_sigma, best_loss, best_conf, n_iters]
+            ops['gd_reset_op'] = gd_reset_op
+        return graph, vars, ops
+
+    def gd_graph_key(self, batch_size):
+        # GD sessions keep the model data and the optimizer state in
+        # variables so they are not safe to share across threads. Each
+        # thread gets its own.
+        return (self.__class__.__name__ + '.gd', self.length_scale,
+                self.magnitude, self.check_numerics, self.solver,
+                self.learning_rate, self.epsilon, self.sigma_multiplier,
+                self.mu_multiplier, self.loss_tol, self.grad_tol,
+                self.patience, self.X_train.shape[1], batch_size,
+                current_thread().ident)
+
+    @contextmanager
+    def pooled_gd_session(self, batch_size):
+        nfeats = self.X_train.shape[1]
+        with SESSION_POOL.session(
+                self.gd_graph_key(batch_size),
+                lambda: self.build_gd_graph(nfeats, batch_size)) as entry:
+            if entry.owner is not self.session_token:
+                # The session holds another model's data (or none at all)
+                self.load_session_data(entry)
+            yield entry
+
+    def load_session_data(self, entry):
+        factor = self.L if self.solver == GPR.SOLVER_CHOLESKY else self.K_inv
+        data = [self.X_train, np.float32(self.xy_), factor]
+        entry.sess.run(entry.ops['load_data_ops'],
+                       feed_dict=dict(zip(entry.vars['data_phs'], data)))
+        entry.owner = self.session_token
+
+    def fit(self, X_train, y_train, ridge=DEFAULT_RIDGE, X_dists=None):
+        y_train = np.asarray(y_train)
+        if y_train.ndim > 1 and y_train.shape[1] != 1:
+            raise Exception("GPR_GD only supports a single output ({})"
+                            .format(y_train.shape[1]))
+        super(GPR_GD, self).fit(X_train, y_train, ridge, X_dists)
+        self.session_token = object()
         return self
 
+    def update_weights(self, L):
+        super(GPR_GD, self).update_weights(L)
+        # The pooled sessions hold the old data
+        self.session_token = object()
+
     def predict(self, X_test, constraint_helper=None,
                 categorical_feature_method='hillclimbing',
                 categorical_feature_steps=3):
-        #from tensorflow.python.framework.errors import InvalidArgumentError
-
         self.check_fitted()
         X_test = np.float32(self.check_array(X_test))
         test_size = X_test.shape[0]
@@ -382,109 +1072,62 @@ class GPR_GD(GPR):
         sigmas = np.zeros([test_size, 1])
         minLs = np.zeros([test_size, 1])
         minL_confs = np.zeros([test_size, nfeats])
+        n_iters = np.zeros([test_size, 1], dtype=int)
+        setup_time = 0.0
+        compute_time = 0.0
 
-        #with tf.Session(graph=self.graph) as sess:
-        with tf.Session(graph=self.graph, config=tf.ConfigProto(
-                intra_op_parallelism_threads=self.NUM_THREADS)) as sess:
-            while arr_offset < test_size:
-                if arr_offset + GPR.BATCH_SIZE > test_size:
-                    end_offset = test_size
-                else:
-                    end_offset = arr_offset + GPR.BATCH_SIZE;
-    
-                X_test_batch = X_test[arr_offset:end_offset];
-                batch_len = end_offset - arr_offset
+        while arr_offset < test_size:
+            if arr_offset + GPR.BATCH_SIZE > test_size:
+                end_offset = test_size
+            else:
+                end_offset = arr_offset + GPR.BATCH_SIZE;
 
-                xt_ = self.vars['xt_']
-                init = tf.global_variables_initializer()
-                sess.run(init)
-
-                sig_val = self.ops['sig_val2']
-                yhat_gd = self.ops['yhat_gd']
-                Loss = self.ops['loss_op']
-                train = self.ops['train_op']
-                
-                xt_ph = self.vars['xt_ph']
-                assign_op = self.ops['xt_assign_op']
-
-                yhat = np.empty((batch_len, 1))
-                sigma = np.empty((batch_len, 1))
-                minL = np.empty((batch_len, 1))
-                minL_conf = np.empty((batch_len, nfeats))
-                for i in range(batch_len):
+            X_test_batch = X_test[arr_offset:end_offset];
+            batch_len = end_offset - arr_offset
+
+            setup_start = time()
+            with self.pooled_gd_session(batch_len) as entry:
+                sess, vars, ops = entry.sess, entry.vars, entry.ops
+                compute_start = time()
+                setup_time += compute_start - setup_start
+
+                # Optimize all starting configurations in this batch together
+                sess.run(ops['gd_reset_op'])
+                sess.run(ops['xt_assign_op'], feed_dict={vars['xt_ph']:X_test_batch})
+                for step in range(self.max_iter):
                     if self.debug is True:
-                        print "-------------------------------------------"
-                    yhats_it = np.empty((self.max_iter+1,)) * np.nan
-                    sigmas_it = np.empty((self.max_iter+1,)) * np.nan
-                    losses_it = np.empty((self.max_iter+1,)) * np.nan
-                    confs_it = np.empty((self.max_iter+1, nfeats)) * np.nan
-                    
-                    sess.run(assign_op, feed_dict={xt_ph:X_test_batch[i]})
-                    for step in range(self.max_iter):
-#                         try:
-                        if self.debug is True:
-                            print "Sample {}, iter {}:".format(i, step)
-                        yhats_it[step] = sess.run(yhat_gd)[0][0]
-                        sigmas_it[step] = sess.run(sig_val)[0][0]
-                        losses_it[step] = sess.run(Loss)
-                        confs_it[step] = sess.run(xt_)
-                        if self.debug is True:
-                            print "    yhat:  {}".format(yhats_it[step])
-                            print "    sigma: {}".format(sigmas_it[step])
-                            print "    loss:  {}".format(losses_it[step])
-                            print "    conf:  {}".format(confs_it[step])
-                        sess.run(train)
-#                             if constraint_helper is not None:
-#                                 xt_valid = constraint_helper.apply_constraints(sess.run(xt_))
-#                                 sess.run(assign_op, feed_dict={xt_ph:xt_valid})
-# 
-#                                 if categorical_feature_method == 'hillclimbing':
-#                                     if step % categorical_feature_steps == 0:
-#                                         current_xt = sess.run(xt_)
-#                                         current_loss = sess.run(Loss)
-#                                         new_xt = constraint_helper.randomize_categorical_features(current_xt)
-#                                         sess.run(assign_op, feed_dict={xt_ph:new_xt})
-#                                         new_loss = sess.run(Loss)
-#                                         if current_loss < new_loss:
-#                                             sess.run(assign_op, feed_dict={xt_ph:current_xt})
-#                                 else:
-#                                     raise Exception("Unknown categorical feature method: {}"
-#                                     .format(categorical_feature_method))
-#                         except:
-#                             break
-                    if step == self.max_iter - 1:
-                        # Record results from final iteration
-                        yhats_it[-1] = sess.run(yhat_gd)[0][0]
-                        sigmas_it[-1] = sess.run(sig_val)[0][0]
-                        losses_it[-1] = sess.run(Loss)
-                        confs_it[-1] = sess.run(xt_)
-                        assert np.all(np.isfinite(yhats_it))
-                        assert np.all(np.isfinite(sigmas_it))
-                        assert np.all(np.isfinite(losses_it))
-                        assert np.all(np.isfinite(confs_it))
-                    
-                    # Store info for conf with min loss from all iters
-                    if np.all(~np.isfinite(losses_it)):
-                        min_loss_idx = 0
+                        losses, _, num_active = sess.run(
+                            [ops['loss_op'], ops['train_op'], ops['num_active_op']])
+                        print "Iter {}: losses={}, active={}".format(
+                            step, losses, num_active)
                     else:
-                        min_loss_idx = np.nanargmin(losses_it)
-                    yhat[i] = yhats_it[min_loss_idx]
-                    sigma[i] = sigmas_it[min_loss_idx]
-                    minL[i] = losses_it[min_loss_idx]
-                    minL_conf[i] = confs_it[min_loss_idx]
-
-                minLs[arr_offset:end_offset] = minL
-                minL_confs[arr_offset:end_offset] = minL_conf
-                yhats[arr_offset:end_offset] = yhat
-                sigmas[arr_offset:end_offset] =  sigma
-                arr_offset = end_offset
+                        _, num_active = sess.run([ops['train_op'],
+                                                  ops['num_active_op']])
+                    if num_active == 0:
+                        break
+
+                # Record results from final iteration
+                sess.run(ops['update_best_op'])
+                yhat, sigma, minL, minL_conf, n_iter = sess.run(ops['best_ops'])
+
+            minLs[arr_offset:end_offset] = minL.reshape(-1, 1)
+            minL_confs[arr_offset:end_offset] = minL_conf
+            yhats[arr_offset:end_offset] = yhat.reshape(-1, 1)
+            sigmas[arr_offset:end_offset] = sigma.reshape(-1, 1)
+            n_iters[arr_offset:end_offset] = n_iter.reshape(-1, 1)
+            arr_offset = end_offset
+            compute_time += time() - compute_start
 
         self.check_output(yhats)
         self.check_output(sigmas)
         self.check_output(minLs)
         self.check_output(minL_confs)
+        self.timings['predict'] = {
+            'setup': setup_time,
+            'compute': compute_time,
+        }
 
-        return GPR_GDResult(yhats, sigmas, minLs, minL_confs)
+        return GPR_GDResult(yhats, sigmas, minLs, minL_confs, n_iters)
 
     @staticmethod
     def calculate_sigma_multiplier(t, ndim, bound=0.1):
@@ -497,7 +1140,156 @@ class GPR_GD(GPR):
         else:
             beta = 1
         return beta
-        
+
+
+class SparseGPR(GPR):
+    # Approximates the GPR with num_inducing of the training rows as
+    # inducing points (the FITC approximation). Fitting takes O(n*m^2) time
+    # for n training rows and m inducing points, so unlike GPR there is no
+    # limit on the training set size. After fitting, X_train and y_train
+    # hold the inducing points, xy_ their weights and K_inv the predictive
+    # factor Kuu^-1 - (Kuu + Kuf Lambda^-1 Kfu)^-1, so prediction,
+    # save_model and load_model work the same way as for an exact model fit
+    # with the inverse solver. K_inv is not the inverse of a kernel matrix
+    # so the model cannot be updated or give leave-one-out predictions.
+
+    DEFAULT_NUM_INDUCING = 500
+
+    def __init__(self, length_scale=1.0, magnitude=1.0, check_numerics=True,
+                 debug=False, solver=GPR.SOLVER_INVERSE,
+                 num_inducing=DEFAULT_NUM_INDUCING, random_state=None):
+        # The predictive factor is not positive definite in general so it
+        # cannot be stored as a Cholesky factor
+        assert solver == GPR.SOLVER_INVERSE
+        assert num_inducing > 0
+        super(SparseGPR, self).__init__(length_scale, magnitude,
+                                        check_numerics, debug, solver)
+        self.num_inducing = num_inducing
+        self.random_state = random_state
+        self.inducing_idxs = None
+
+    def check_X_y(self, X, y):
+        from sklearn.utils.validation import check_X_y
+
+        return check_X_y(X, y, multi_output=True,
+                         allow_nd=True, y_numeric=True,
+                         estimator="SparseGPR")
+
+    def cholesky(self, K):
+        # Same as factorize but in double precision, which the sparse
+        # updates need to stay accurate
+        base_jitter = self.CHOLESKY_JITTER * np.mean(np.diag(K))
+        jitter = 0.0
+        for _ in range(self.MAX_CHOLESKY_TRIES):
+            try:
+                K_jitter = K if jitter == 0.0 else \
+                    K + jitter * np.eye(K.shape[0])
+                return cholesky(K_jitter, lower=True), jitter
+            except LinAlgError:
+                jitter = base_jitter if jitter == 0.0 else jitter * 10
+                if self.debug is True:
+                    print "Cholesky failed, retrying with jitter={}".format(jitter)
+        raise Exception("Kernel matrix is not positive definite "
+                        "(jitter={})".format(jitter))
+
+    def fit(self, X_train, y_train, ridge=1.0, X_dists=None):
+        # X_dists is ignored: only the distances to the inducing points are
+        # needed and they are cheap to compute
+        setup_start = time()
+        self._reset()
+        X_train, y_train = self.check_X_y(X_train, y_train)
+        if y_train.ndim == 1:
+            y_train = y_train.reshape(-1, 1)
+        X_train = np.float32(X_train)
+        y_train = np.float64(y_train)
+        sample_size = X_train.shape[0]
+
+        if np.isscalar(ridge):
+            ridge = np.ones(sample_size) * ridge
+        assert ridge.ndim == 1
+
+        # The inducing points are a random subset of the training rows. Rows
+        # with less noise are picked first (e.g. the target workload's rows
+        # in configuration_recommendation).
+        num_inducing = min(self.num_inducing, sample_size)
+        rng = np.random.RandomState(self.random_state)
+        order = np.lexsort((rng.permutation(sample_size), ridge))
+        self.inducing_idxs = np.sort(order[:num_inducing])
+        X_inducing = X_train[self.inducing_idxs]
+
+        with self.pooled_session() as sess:
+            compute_start = time()
+            Luu, self.jitter = self.cholesky(
+                self.compute_kernel(sess, X_inducing, X_inducing))
+
+            # Accumulates A = I + V Lambda^-1 V^T and b = V Lambda^-1 y where
+            # V = Luu^-1 Kuf over batches of training rows, so the full m x n
+            # kernel matrix is never materialized
+            A = np.eye(num_inducing)
+            b = np.zeros((num_inducing, y_train.shape[1]))
+            for start in range(0, sample_size, self.BATCH_SIZE):
+                end = min(start + self.BATCH_SIZE, sample_size)
+                Kuf = self.compute_kernel(sess, X_inducing, X_train[start:end])
+                V = solve_triangular(Luu, Kuf, lower=True)
+                # FITC adds the variance that the inducing points do not
+                # explain (the diagonal of Kff - Qff) to the noise
+                lam = ridge[start:end] + \
+                    np.maximum(self.magnitude - np.sum(np.square(V), 0), 0.0)
+                V_lam = V / lam
+                A += np.dot(V_lam, V.T)
+                b += np.dot(V_lam, y_train[start:end])
+
+        # xy_ = Luu^-T A^-1 b and K_inv = Luu^-T (I - A^-1) Luu^-1
+        LA = cholesky(A, lower=True)
+        Luu_inv = solve_triangular(Luu, np.eye(num_inducing), lower=True)
+        xy = np.dot(Luu_inv.T, cho_solve((LA, True), b))
+        A_inv = cho_solve((LA, True), np.eye(num_inducing))
+        K_inv = np.dot(Luu_inv.T, np.dot(np.eye(num_inducing) - A_inv, Luu_inv))
+
+        self.X_train = X_inducing
+        self.y_train = np.float32(y_train[self.inducing_idxs])
+        self.ridge_train = np.float32(ridge[self.inducing_idxs])
+        self.xy_ = np.float32(xy)
+        self.K_inv = np.float32(K_inv)
+        self.record_timing('fit', setup_start, compute_start)
+        return self
+
+    def predict(self, X_test, X_dists=None):
+        # Like for GPR, X_dists holds the distances between all of the
+        # training rows and X_test ([n_train, n_test]). Only the rows of the
+        # inducing points are needed. They are unknown for models from
+        # load_model so the distances are recomputed.
+        if X_dists is not None:
+            if self.inducing_idxs is None:
+                X_dists = None
+            else:
+                X_dists = X_dists[self.inducing_idxs]
+        return super(SparseGPR, self).predict(X_test, X_dists)
+
+    def check_updatable(self):
+        raise Exception("SparseGPR models cannot be updated; refit the "
+                        "model instead")
+
+    def loo_predict(self):
+        raise Exception("SparseGPR does not support leave-one-out "
+                        "predictions; use k-fold cross validation instead")
+
+    def _reset(self):
+        super(SparseGPR, self)._reset()
+        self.inducing_idxs = None
+
+
+class SparseGPR_GD(GPR_GD, SparseGPR):
+    # GPR_GD's gradient descent over a SparseGPR. GPR_GD.fit defers to
+    # SparseGPR.fit (which is next in the MRO) and its graphs only use
+    # X_train, xy_ and K_inv, so they run over the inducing points.
+
+    def __init__(self, num_inducing=SparseGPR.DEFAULT_NUM_INDUCING,
+                 random_state=None, solver=GPR.SOLVER_INVERSE, **kwargs):
+        super(SparseGPR_GD, self).__init__(solver=solver, **kwargs)
+        self.num_inducing = num_inducing
+        self.random_state = random_state
+
 
 #def gp_tf(X_train, y_train, X_test, ridge, length_scale, magnitude, batch_size=3000):
 #    with tf.Graph().as_default():
@@ -690,6 +1482,159 @@ def create_random_matrices(n_samples=3000, n_feats=12, n_test=4444):
     
     return X_train, y_train, X_test, length_scale, magnitude, ridge
 
+def check_dist_equivalence(n_samples=2500, n_feats=12, n_test=1500):
+    X_train, _, X_test, _, _, _ = create_random_matrices(n_samples, n_feats, n_test)
+    X_train = np.float32(X_train)
+    X_test = np.float32(X_test)
+
+    # Row-at-a-time distances (the original GPR implementation)
+    loop_dists = np.empty((n_samples, n_test), dtype=np.float32)
+    for i in range(n_samples):
+        loop_dists[i] = np.sqrt(np.sum(np.square(X_train[i] - X_test), axis=1))
+
+    gpr = GPR()
+    gpr.build_graph()
+    with tf.Session(graph=gpr.graph) as sess:
+        dists = gpr.compute_dists(sess, X_train, X_test)
+        self_dists = gpr.compute_dists(sess, X_test, X_test)
+    assert np.allclose(dists, loop_dists, atol=1e-5)
+    assert np.allclose(np.diag(self_dists), 0.0, atol=1e-5)
+    print "Distance computations are equivalent."
+
+def check_solver_equivalence(n_samples=2000, n_feats=12, n_test=1000):
+    X_train, y_train, X_test, length_scale, magnitude, ridge = \
+        create_random_matrices(n_samples, n_feats, n_test)
+    gpr_inv = GPR(length_scale, magnitude, solver=GPR.SOLVER_INVERSE)
+    gpr_inv.fit(X_train, y_train, ridge)
+    gpres_inv = gpr_inv.predict(X_test)
+    gpr_chol = GPR(length_scale, magnitude, solver=GPR.SOLVER_CHOLESKY)
+    gpr_chol.fit(X_train, y_train, ridge)
+    gpres_chol = gpr_chol.predict(X_test)
+    assert np.allclose(gpres_inv.ypreds, gpres_chol.ypreds, atol=1e-3)
+    assert np.allclose(gpres_inv.sigmas, gpres_chol.sigmas, atol=1e-3)
+    print "Inverse and Cholesky solvers are equivalent (jitter={})." \
+        .format(gpr_chol.jitter)
+
+def check_update_equivalence(n_samples=1000, n_feats=12, n_test=500,
+                             n_new=50, n_removed=30):
+    X_train, y_train, X_test, length_scale, magnitude, _ = \
+        create_random_matrices(n_samples + n_new, n_feats, n_test)
+    removed = np.random.choice(n_samples + n_new, n_removed, replace=False)
+    keep = np.ones(n_samples + n_new, dtype=bool)
+    keep[removed] = False
+
+    gpr = GPR(length_scale, magnitude)
+    gpr.fit(X_train[:n_samples], y_train[:n_samples], 0.1)
+    gpr.append(X_train[n_samples:], y_train[n_samples:], 0.1)
+    gpr.remove(removed)
+    gpres = gpr.predict(X_test)
+    gpr_refit = GPR(length_scale, magnitude)
+    gpr_refit.fit(X_train[keep], y_train[keep], 0.1)
+    gpres_refit = gpr_refit.predict(X_test)
+    assert np.allclose(gpres.ypreds, gpres_refit.ypreds, atol=1e-3)
+    assert np.allclose(gpres.sigmas, gpres_refit.sigmas, atol=1e-3)
+    print "Updated and refit models are equivalent."
+
+def check_loo_equivalence(n_samples=500, n_feats=12, n_checked=20):
+    X_train, y_train, _, length_scale, magnitude, ridge = \
+        create_random_matrices(n_samples, n_feats, 1)
+    gpr = GPR(length_scale, magnitude)
+    loo_res = gpr.fit(X_train, y_train, ridge).loo_predict()
+    for i in np.random.choice(n_samples, n_checked, replace=False):
+        keep = np.arange(n_samples) != i
+        gpr_i = GPR(length_scale, magnitude)
+        gpr_i.fit(X_train[keep], y_train[keep], ridge[keep])
+        gpres = gpr_i.predict(X_train[i:i + 1])
+        assert np.allclose(loo_res.ypreds[i], gpres.ypreds[0], atol=1e-3)
+        assert np.allclose(loo_res.sigmas[i], gpres.sigmas[0], atol=1e-3)
+    print "Closed-form and refit leave-one-out predictions are equivalent."
+
+def benchmark_update(sample_sizes=(1000, 2000, 3000, 5000), n_feats=12):
+    # Time to add one row to a fitted model vs. refitting it
+    print "n_samples\trefit (sec)\tappend (sec)\tremove (sec)"
+    for n_samples in sample_sizes:
+        X_train, y_train, _, length_scale, magnitude, _ = \
+            create_random_matrices(n_samples + 1, n_feats, 1)
+        gpr = GPR(length_scale, magnitude)
+        start = time()
+        gpr.fit(X_train, y_train, 0.1)
+        refit_time = time() - start
+        gpr.fit(X_train[:-1], y_train[:-1], 0.1)
+        start = time()
+        gpr.append(X_train[-1:], y_train[-1:], 0.1)
+        append_time = time() - start
+        start = time()
+        gpr.remove([0])
+        remove_time = time() - start
+        print "{}\t\t{:.3f}\t\t{:.3f}\t\t{:.3f}".format(
+            n_samples, refit_time, append_time, remove_time)
+
+def benchmark_gpr(sample_sizes=(500, 1000, 2000, 3000, 5000, GPR.MAX_TRAIN_SIZE),
+                  n_feats=12, n_test=1000):
+    print "n_samples\tfit (sec)\tpredict (sec)"
+    for n_samples in sample_sizes:
+        X_train, y_train, X_test, length_scale, magnitude, ridge = \
+            create_random_matrices(n_samples, n_feats, n_test)
+        gpr = GPR(length_scale, magnitude)
+        start = time()
+        gpr.fit(X_train, y_train, ridge)
+        fit_time = time() - start
+        start = time()
+        gpr.predict(X_test)
+        predict_time = time() - start
+        print "{}\t\t{:.3f}\t\t{:.3f}".format(n_samples, fit_time, predict_time)
+
+def create_sparse_matrices(n_samples, n_feats=12, n_test=1000, noise=0.1):
+    # Samples a smooth function plus noise so the sparse and exact models
+    # can also be compared against the noiseless truth
+    X_train = np.random.rand(n_samples, n_feats)
+    X_test = np.random.rand(n_test, n_feats)
+    f = lambda X: np.sin(3 * X).sum(axis=1, keepdims=True) / np.sqrt(n_feats)
+    y_train = f(X_train) + noise * np.random.randn(n_samples, 1)
+    return X_train, y_train, X_test, f(X_test)
+
+def check_sparse_equivalence(n_samples=1000, n_feats=12, n_test=500):
+    # With every training row as an inducing point FITC is exact
+    X_train, y_train, X_test, _ = create_sparse_matrices(n_samples, n_feats,
+                                                         n_test)
+    gpres = GPR().fit(X_train, y_train, 0.01).predict(X_test)
+    sparse_gpr = SparseGPR(num_inducing=n_samples)
+    sparse_gpres = sparse_gpr.fit(X_train, y_train, 0.01).predict(X_test)
+    assert np.allclose(gpres.ypreds, sparse_gpres.ypreds, atol=1e-3)
+    assert np.allclose(gpres.sigmas, sparse_gpres.sigmas, atol=1e-3)
+    print "Exact and sparse GPR are equivalent (jitter={})." \
+        .format(sparse_gpr.jitter)
+
+def benchmark_sparse_gpr(sample_sizes=(5000, 20000, 100000),
+                         num_inducing=(100, 500, 1000), n_feats=12,
+                         n_test=1000, ridge=0.01):
+    # The exact GPR is only fit when the sample size is within its limit.
+    # rmse is measured against the noiseless function and diff is the mean
+    # absolute difference from the exact predictions.
+    print "n_samples\tmodel\t\tfit (sec)\tpredict (sec)\trmse\tdiff"
+    for n_samples in sample_sizes:
+        X_train, y_train, X_test, y_true = create_sparse_matrices(
+            n_samples, n_feats, n_test)
+        models = [('sparse_{}'.format(m), SparseGPR(num_inducing=m))
+                  for m in num_inducing]
+        if n_samples <= GPR.MAX_TRAIN_SIZE:
+            models.insert(0, ('exact', GPR()))
+        exact_ypreds = None
+        for name, model in models:
+            start = time()
+            model.fit(X_train, y_train, ridge)
+            fit_time = time() - start
+            start = time()
+            ypreds = model.predict(X_test).ypreds
+            predict_time = time() - start
+            if name == 'exact':
+                exact_ypreds = ypreds
+            rmse = np.sqrt(np.mean(np.square(ypreds - y_true)))
+            diff = 'n/a' if exact_ypreds is None else \
+                '{:.4f}'.format(np.mean(np.abs(ypreds - exact_ypreds)))
+            print "{}\t\t{:<12}\t{:.3f}\t\t{:.3f}\t\t{:.4f}\t{}".format(
+                n_samples, name, fit_time, predict_time, rmse, diff)
+
 # def check_equivalence():
 #     X_train, y_train, X_test, length_scale, magnitude, ridge = create_random_matrices()
 #     
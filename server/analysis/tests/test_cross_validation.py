@@ -0,0 +1,68 @@
+'''
+Tests for GridSearch. Run from the server directory with:
+
+    python -m unittest discover -s analysis/tests -t .
+'''
+
+import unittest
+
+import numpy as np
+
+from analysis.cross_validation import GridSearch, gpvar_cv, rmse_cv
+from analysis.gp_tf import GPR, GPR_GD, SparseGPR
+
+
+class GridSearchTest(unittest.TestCase):
+
+    N_SAMPLES = 120
+    N_FEATS = 4
+    NUM_INDUCING = 20
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.rand(self.N_SAMPLES, self.N_FEATS)
+        self.y = np.sin(3 * self.X).sum(axis=1, keepdims=True) + \
+            0.1 * rng.randn(self.N_SAMPLES, 1)
+
+    def run_search(self, estimator_cls, parameters, share_dists, njobs=1):
+        search = GridSearch(estimator_cls, [parameters], [rmse_cv, gpvar_cv],
+                            nfolds=3, njobs=njobs, share_dists=share_dists)
+        search.fit(self.X, self.y)
+        return search.grid_scores[0]
+
+    def check_shared_dists(self, estimator_cls, parameters):
+        # Sharing the distances must not change the scores
+        shared = self.run_search(estimator_cls, parameters, True)
+        unshared = self.run_search(estimator_cls, parameters, False)
+        self.assertTrue(np.all(np.isfinite(shared.cv_scores)))
+        np.testing.assert_allclose(shared.cv_scores, unshared.cv_scores,
+                                   rtol=1e-3, atol=1e-4)
+
+    def test_kfold_gpr(self):
+        self.check_shared_dists(GPR, {'length_scale': 1.0})
+
+    def test_kfold_sparse_gpr(self):
+        # Each fold has more training rows than inducing points
+        self.assertGreater(self.N_SAMPLES * 2 / 3, self.NUM_INDUCING)
+        self.check_shared_dists(SparseGPR, {'num_inducing': self.NUM_INDUCING,
+                                            'random_state': 0})
+
+    def test_kfold_gpr_gd(self):
+        # GPR_GD's predict does not take X_dists
+        score = self.run_search(GPR_GD, {'max_iter': 5}, True)
+        self.assertTrue(np.all(np.isfinite(score.cv_scores)))
+
+    def test_kfold_parallel(self):
+        # The parent has used TF before the pool forks
+        GPR().fit(self.X, self.y).predict(self.X)
+        serial = self.run_search(SparseGPR, {'num_inducing': self.NUM_INDUCING,
+                                             'random_state': 0}, True)
+        parallel = self.run_search(SparseGPR,
+                                   {'num_inducing': self.NUM_INDUCING,
+                                    'random_state': 0}, True, njobs=2)
+        np.testing.assert_allclose(serial.cv_scores, parallel.cv_scores,
+                                   rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
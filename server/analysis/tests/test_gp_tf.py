@@ -0,0 +1,49 @@
+'''
+Tests for the GPR models. Run from the server directory with:
+
+    python -m unittest discover -s analysis/tests -t .
+'''
+
+import unittest
+
+import numpy as np
+
+from analysis.gp_tf import SparseGPR
+
+
+class SparseGPRTest(unittest.TestCase):
+
+    N_SAMPLES = 100
+    N_FEATS = 4
+    NUM_INDUCING = 20
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.rand(self.N_SAMPLES, self.N_FEATS)
+        self.y = np.sin(3 * self.X).sum(axis=1, keepdims=True)
+        self.model = SparseGPR(num_inducing=self.NUM_INDUCING,
+                               random_state=0)
+        self.model.fit(self.X, self.y, ridge=0.01)
+
+    def test_training_data(self):
+        # The training data only holds the inducing points
+        model = self.model
+        self.assertEqual(model.X_train.shape,
+                         (self.NUM_INDUCING, self.N_FEATS))
+        self.assertEqual(model.y_train.shape, (self.NUM_INDUCING, 1))
+        self.assertEqual(model.ridge_train.shape, (self.NUM_INDUCING,))
+        self.assertEqual(model.xy_.shape, (self.NUM_INDUCING, 1))
+        np.testing.assert_allclose(model.y_train,
+                                   self.y[model.inducing_idxs], rtol=1e-6)
+
+    def test_unsupported(self):
+        with self.assertRaisesRegexp(Exception, 'cannot be updated'):
+            self.model.append(self.X[:1], self.y[:1])
+        with self.assertRaisesRegexp(Exception, 'cannot be updated'):
+            self.model.remove([0])
+        with self.assertRaisesRegexp(Exception, 'leave-one-out'):
+            self.model.loo_predict()
+
+
+if __name__ == '__main__':
+    unittest.main()
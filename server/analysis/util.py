@@ -76,6 +76,25 @@ def is_lexical_matrix(matrix):
     assert matrix.size > 0
     return isinstance(matrix.ravel()[0], str)
 
+def get_grouped_median(values, groups):
+    """Computes the column-wise median of the rows of values in each
+    group, where groups[i] is the group (0, ..., k-1) of row i. Each column
+    is sorted once by (group, value) so that the medians can be read off
+    the segments directly. Returns a k x m matrix."""
+    values = np.asarray(values)
+    groups = np.asarray(groups)
+    n, m = values.shape
+    cols = np.arange(m)
+    ranks = np.empty((n, m), dtype=np.int64)
+    ranks[np.argsort(values, axis=0, kind='mergesort'), cols] = \
+        np.arange(n).reshape(-1, 1)
+    order = np.argsort(groups.reshape(-1, 1) * n + ranks, axis=0)
+    sorted_values = values[order, cols]
+    counts = np.bincount(groups)
+    starts = np.cumsum(counts) - counts
+    return (sorted_values[starts + (counts - 1) // 2] +
+            sorted_values[starts + counts // 2]) / 2.0
+
 def get_unique_matrix(X, y):
     X_unique, unique_indexes = X.unique_rows(return_index=True)
     assert np.array_equal(X_unique.columnlabels, X.columnlabels)
@@ -94,22 +113,15 @@ def get_unique_matrix(X, y):
     X_unique.rowlabels = rowlabels
     if X_unique.data.shape != X.data.shape:
         print "\n\nDIFF(num_knobs={}): X_unique: {}, X: {}\n\n".format(X_unique.columnlabels.shape[0], X_unique.data.shape, X.data.shape)
-        dup_map = {}
-        dup_indexes = np.array([d for d in range(X.data.shape[0]) \
-                                if d not in unique_indexes])
-        for dup_idx in dup_indexes:
-            dup_label = tuple((u''+l,r) for l,r in \
-                              zip(X_unique.columnlabels,
-                                  X.data[dup_idx]))
-            primary_idx = [idx for idx,rl in enumerate(rowlabels) \
-                           if rl == dup_label]
-            assert len(primary_idx) == 1
-            primary_idx = primary_idx[0]
-            if primary_idx not in dup_map:
-                dup_map[primary_idx] = [y_unique.data[primary_idx]]
-            dup_map[primary_idx].append(y.data[dup_idx])
-        for idx, yvals in dup_map.iteritems():
-            y_unique.data[idx] = np.median(np.vstack(yvals), axis=0)
+        # Map each row of X to its unique row (unique_indexes holds the
+        # first occurrence of each unique row in sorted order)
+        cdata = np.ascontiguousarray(X.data).view(np.dtype(
+                (np.void, X.data.dtype.itemsize * X.data.shape[1])))
+        _, first_indexes, invs = np.unique(cdata, return_index=True,
+                                           return_inverse=True)
+        positions = np.empty_like(first_indexes)
+        positions[np.argsort(first_indexes)] = np.arange(first_indexes.size)
+        y_unique.data = get_grouped_median(y.data, positions[invs])
     return X_unique, y_unique
 
 
@@ -16,7 +16,7 @@ import numpy as np
 import operator
 from sklearn.preprocessing import StandardScaler
 
-from .gp_tf import GPR
+from .gp_tf import GPR, SparseGPR
 from common.matrix import Matrix
 from .util import get_unique_matrix
 import analysis.preprocessing as prep
@@ -24,10 +24,10 @@ from .util import stopwatch
 
 class WorkloadState(object):
 
-    def __init__(self, X=None, y=None, models=None):
+    def __init__(self, X=None, y=None, model=None):
         self.X = X
         self.y = y
-        self.models = models
+        self.model = model
 
     @staticmethod
     def compress(workload_state):
@@ -42,17 +42,16 @@ def worker_create_model((worker_id, workload_name, data, njobs, verbose)):
         print "{}: building models for {}".format(worker_id,
                                                   os.path.basename(workload_name))
     X, y = data
-    models = {}
-    for col, label in zip(y.data.T, y.columnlabels):
-        if verbose:
-            print "    {}: {}".format(worker_id, label)
-        length_scale, magnitude, ridge_const = 1., 1., 1.
-        ridge = np.ones(X.data.shape[0]) * ridge_const
-        col = col.reshape(-1, 1)
+    # All metrics share the same kernel so a single multi-output model is
+    # fit for the whole workload
+    length_scale, magnitude, ridge_const = 1., 1., 1.
+    ridge = np.ones(X.data.shape[0]) * ridge_const
+    if X.data.shape[0] > WorkloadMapper.MAX_SAMPLES:
+        model = SparseGPR(length_scale, magnitude)
+    else:
         model = GPR(length_scale, magnitude)
-        model.fit(X.data, col, ridge)
-        models[label] = model
-    workload_state = WorkloadState(X, y, models)
+    model.fit(X.data, y.data, ridge)
+    workload_state = WorkloadState(X, y, model)
     workload_state = WorkloadState.compress(workload_state)
     if verbose:
         print "{}: done. ({}/{})".format(worker_id, worker_id+1, njobs)
@@ -70,14 +69,7 @@ def worker_score_workload((worker_id, workload_name, workload_state,
                           y_client.columnlabels)
 
     # Make all predictions
-    metrics = workload_state.y.columnlabels
-    predictions = np.empty_like(y_client.data)
-    for i, metric in enumerate(metrics):
-        if verbose:
-            print "    {}: {}".format(worker_id, metric)
-        model = workload_state.models[metric]
-        res = model.predict(X_client.data)
-        predictions[:, i] = res.ypreds.ravel()
+    predictions = workload_state.model.predict(X_client.data).ypreds
 
     # Compute distance
     dists = np.sum(np.square(np.subtract(predictions, y_client.data)), axis=1)
@@ -89,6 +81,7 @@ def worker_score_workload((worker_id, workload_name, workload_state,
 class WorkloadMapper(object):
 
     POOL_SIZE = 8
+    # Workloads with more samples than this use a sparse GPR
     MAX_SAMPLES = 5000
     
     def __init__(self, dbms_name, featured_knobs, featured_metrics,
@@ -146,17 +139,6 @@ class WorkloadMapper(object):
                 assert np.array_equal(y.columnlabels, self.featured_metrics_)
                 assert np.array_equal(X.rowlabels, y.rowlabels)
                 num_samples = X.shape[0]
-                if num_samples > self.MAX_SAMPLES:
-                    print "Shrinking {} samples to {}".format(num_samples, self.MAX_SAMPLES)
-                    rand_indices = prep.get_shuffle_indices(num_samples)[:self.MAX_SAMPLES]
-                    X = Matrix(X.data[rand_indices],
-                               X.rowlabels[rand_indices],
-                               X.columnlabels)
-                    y = Matrix(y.data[rand_indices],
-                               y.rowlabels[rand_indices],
-                               y.columnlabels)
-                num_samples = X.shape[0]
-                assert num_samples <= self.MAX_SAMPLES
                 assert num_samples == y.shape[0]
  
                 # Dummy-code categorical knobs
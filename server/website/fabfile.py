@@ -155,8 +155,10 @@ def recreate_website_dbms():
 
 
 @task
-def aggregate_results():
-    cmd = 'from website.tasks import aggregate_results; aggregate_results()'
+def aggregate_results(incremental=True):
+    incremental = str(incremental).lower() != 'false'
+    cmd = ('from website.tasks import aggregate_results; '
+           'aggregate_results(incremental={})').format(incremental)
     local(('export PYTHONPATH={}\:$PYTHONPATH; '
            'django-admin shell --settings=website.settings '
            '-c\"{}\"').format(PROJECT_ROOT, cmd))
@@ -0,0 +1,94 @@
+'''
+Compares the load time and memory usage of the compressed .npz pipeline
+artifacts against the uncompressed, memory-mapped .npy artifacts.
+
+Usage: python script/benchmark_artifacts.py [num_workloads ...]
+'''
+
+import sys
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import Process, Queue
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'website.settings')
+
+import django
+django.setup()
+
+from website.utils import ArtifactUtil
+
+NUM_WORKLOADS = [10, 50, 200]
+NUM_SAMPLES = 500
+NUM_KNOBS = 100
+NUM_METRICS = 200
+
+
+def get_rss():
+    # Current resident set size in bytes (Linux only)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def create_workloads(savedir, num_workloads):
+    npz_paths = []
+    npy_paths = []
+    for i in range(num_workloads):
+        entry = {
+            'X_matrix': np.random.rand(NUM_SAMPLES, NUM_KNOBS),
+            'y_matrix': np.random.rand(NUM_SAMPLES, NUM_METRICS),
+            'rowlabels': np.arange(NUM_SAMPLES),
+            'X_columnlabels': np.array(['knob_{}'.format(j) for j in range(NUM_KNOBS)]),
+            'y_columnlabels': np.array(['metric_{}'.format(j) for j in range(NUM_METRICS)]),
+        }
+        npz_path = os.path.join(savedir, 'workload_{}.npz'.format(i))
+        np.savez_compressed(npz_path, **entry)
+        npz_paths.append(npz_path)
+        npy_paths.append(ArtifactUtil.save(
+            os.path.join(savedir, 'workload_{}'.format(i)), **entry))
+    return npz_paths, npy_paths
+
+
+def load_workloads((paths, queue)):
+    # Mimics map_workload: every workload is opened and its matrices read
+    rss_start = get_rss()
+    start = time()
+    total = 0.0
+    for path in paths:
+        data = ArtifactUtil.load(path)
+        total += data['X_matrix'][:, 0].sum() + data['y_matrix'][:, 0].sum()
+    queue.put((time() - start, get_rss() - rss_start))
+
+
+def run_in_process(paths):
+    # Each measurement runs in a fresh process so the RSS numbers are not
+    # polluted by earlier runs
+    queue = Queue()
+    proc = Process(target=load_workloads, args=((paths, queue),))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def main():
+    num_workloads = [int(n) for n in sys.argv[1:]] or NUM_WORKLOADS
+    print "{:>10} {:>8} {:>10} {:>10}".format('workloads', 'format', 'time (s)',
+                                              'rss (MB)')
+    for n in num_workloads:
+        savedir = tempfile.mkdtemp()
+        try:
+            npz_paths, npy_paths = create_workloads(savedir, n)
+            for fmt, paths in (('npz', npz_paths), ('npy', npy_paths)):
+                elapsed, rss = run_in_process(paths)
+                print "{:>10} {:>8} {:>10.3f} {:>10.1f}".format(
+                    n, fmt, elapsed, rss / 1024. / 1024.)
+        finally:
+            shutil.rmtree(savedir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Compares the old tuple-based duplicate row filter used by
+configuration_recommendation against DataUtil.isin_rows.
+
+Usage: python script/benchmark_dedup.py [num_rows ...]
+'''
+
+import sys
+import os.path
+import numpy as np
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'website.settings')
+
+import django
+django.setup()
+
+from website.utils import DataUtil
+
+NUM_ROWS = [1000, 5000, 20000, 50000]
+NUM_KNOBS = 10
+DUP_FRACTION = 0.1
+
+# The tuple-based filter is quadratic so it is skipped for larger inputs
+MAX_TUPLE_ROWS = 5000
+
+
+def tuple_filter(X_wkld, X_target):
+    dups_filter = np.ones(X_wkld.shape[0], dtype=bool)
+    target_row_tups = [tuple(row) for row in X_target]
+    for i, row in enumerate(X_wkld):
+        if tuple(row) in target_row_tups:
+            dups_filter[i] = False
+    return dups_filter
+
+
+def hashed_filter(X_wkld, X_target):
+    return ~DataUtil.isin_rows(X_wkld, X_target)
+
+
+def create_matrices(num_rows):
+    # Knob settings are discretized so rows repeat like they do in practice
+    X_wkld = np.random.randint(0, 10, (num_rows, NUM_KNOBS)).astype(float)
+    X_target = np.random.randint(0, 10, (num_rows, NUM_KNOBS)).astype(float)
+    num_dups = int(num_rows * DUP_FRACTION)
+    X_target[:num_dups] = X_wkld[np.random.choice(num_rows, num_dups)]
+    return X_wkld, X_target
+
+
+def main():
+    num_rows = [int(n) for n in sys.argv[1:]] or NUM_ROWS
+    print "{:>8} {:>12} {:>12}".format('rows', 'tuple (s)', 'hashed (s)')
+    for n in num_rows:
+        X_wkld, X_target = create_matrices(n)
+        start = time()
+        hashed_res = hashed_filter(X_wkld, X_target)
+        hashed_time = time() - start
+        if n <= MAX_TUPLE_ROWS:
+            start = time()
+            tuple_res = tuple_filter(X_wkld, X_target)
+            tuple_time = '{:.3f}'.format(time() - start)
+            assert np.array_equal(tuple_res, hashed_res)
+        else:
+            tuple_time = 'skipped'
+        print "{:>8} {:>12} {:>12.3f}".format(n, tuple_time, hashed_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
 import sys
+import os
 import os.path
 import glob
 import json
+import tarfile
+import tempfile
 import numpy as np
+from contextlib import closing
 
 from poster.encode import multipart_encode
 from poster.streaminghttp import register_openers
@@ -22,11 +26,45 @@ class ResultUploader(object):
 
     REQ_EXTS = [SUMMARY_EXT, PARAMS_EXT, METRICS_EXT, SAMPLES_EXT, EXPCFG_EXT]
 
-    def __init__(self, upload_code, upload_url):
+    # Files included in each result bundle of an archive upload
+    ARCHIVE_EXTS = [SUMMARY_EXT, PARAMS_EXT, METRICS_EXT, EXPCFG_EXT]
+
+    def __init__(self, upload_code, upload_url, batch_upload_url=None):
         self.upload_code_ = upload_code
         self.upload_url_ = upload_url
+        self.batch_upload_url_ = batch_upload_url
 
     def upload_batch(self, directories, max_files=5):
+        for basepath, cluster_name in self.get_results(directories, max_files):
+            self.upload(basepath, cluster_name)
+
+    def upload_archive(self, directories, max_files=5):
+        # Uploads all of the results in a single request by packing them
+        # into a tar archive (one <cluster_name>/<name>.* bundle per result)
+        assert self.batch_upload_url_ is not None
+        fd, archive_path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        try:
+            with closing(tarfile.open(archive_path, 'w:gz')) as archive:
+                for basepath, cluster_name in self.get_results(directories,
+                                                               max_files):
+                    arcbase = os.path.join(cluster_name,
+                                           os.path.basename(basepath))
+                    for ext in self.ARCHIVE_EXTS:
+                        archive.add(basepath + ext, arcname=arcbase + ext)
+            with open(archive_path, 'rb') as f:
+                params = {
+                    'upload_code': self.upload_code_,
+                    'results_archive': f,
+                }
+                datagen, headers = multipart_encode(params)
+                request = urllib2.Request(self.batch_upload_url_, datagen,
+                                          headers)
+                print urllib2.urlopen(request).read()
+        finally:
+            os.remove(archive_path)
+
+    def get_results(self, directories, max_files=5):
         for d in directories:
             cluster_name = os.path.basename(d)
             fnames = glob.glob(os.path.join(d, '*.summary'))
@@ -48,7 +86,7 @@ class ResultUploader(object):
                         break
                 if complete == False:
                     continue
-                self.upload(base, cluster_name)
+                yield base, cluster_name
 
     def upload(self, basepath, cluster_name):
         exts = list(self.REQ_EXTS)
@@ -77,12 +115,13 @@ class ResultUploader(object):
 
 def main():
     url = 'http://0.0.0.0:8000/new_result/'
+    batch_url = 'http://0.0.0.0:8000/new_result_batch/'
     upload_code = 'O50GE1HC8S1BHU8L6F8D'
-    uploader = ResultUploader(upload_code, url)
+    uploader = ResultUploader(upload_code, url, batch_url)
     dirnames = glob.glob(os.path.join(os.path.expanduser('~'), 'Dropbox/Apps/ottertune/data/sample_data/exps_*'))[:2]
     #order = np.random.choice(np.arange(len(dirnames)), len(dirnames))
     #dirnames = [dirnames[i] for i in order]
-    uploader.upload_batch(dirnames, max_files=3)
+    uploader.upload_archive(dirnames, max_files=3)
 
 if __name__ == '__main__':
     main()
@@ -17,6 +17,11 @@ class NewResultForm(forms.Form):
     cluster_name = forms.CharField(max_length=128, required=False)
 
 
+class NewResultBatchForm(forms.Form):
+    upload_code = forms.CharField(max_length=30)
+    results_archive = forms.FileField()
+
+
 class ProjectForm(forms.ModelForm):
 
     class Meta:
@@ -2,6 +2,7 @@ from collections import namedtuple, OrderedDict
 
 import xml.dom.minidom
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import (validate_comma_separated_integer_list,
                                     MinValueValidator)
@@ -461,6 +462,12 @@ class ResultData(models.Model):
     param_data = models.TextField()
     metric_data = models.TextField()
 
+    # The knob/metric values as float64 arrays ordered by their sorted
+    # labels. The schema version identifies the labels (see DataUtil).
+    schema_version = models.CharField(max_length=40, null=True)
+    param_values = models.BinaryField(null=True)
+    metric_values = models.BinaryField(null=True)
+
     class Meta:
         ordering = ('cluster',)
 
@@ -469,6 +476,9 @@ class ResultData(models.Model):
 
 
 class PipelineResult(models.Model):
+    # Number of seconds get_latest() caches its result for
+    LATEST_CACHE_TIMEOUT = 60
+
     dbms = models.ForeignKey(DBMSCatalog)
     hardware = models.ForeignKey(Hardware)
     creation_timestamp = models.DateTimeField()
@@ -477,13 +487,33 @@ class PipelineResult(models.Model):
 
     @staticmethod
     def get_latest(dbms, hardware, task_type):
-        results = PipelineResult.objects.filter(
-            dbms=dbms, hardware=hardware, task_type=task_type)
-        return None if len(results) == 0 else results.latest()
+        key = PipelineResult._get_latest_cache_key(dbms, hardware, task_type)
+        result = cache.get(key)
+        if result is None:
+            try:
+                result = PipelineResult.objects.filter(
+                    dbms=dbms, hardware=hardware, task_type=task_type).latest()
+            except PipelineResult.DoesNotExist:
+                return None
+            cache.set(key, result, PipelineResult.LATEST_CACHE_TIMEOUT)
+        return result
+
+    @staticmethod
+    def _get_latest_cache_key(dbms, hardware, task_type):
+        return 'pipeline_result_latest_{}_{}_{}'.format(
+            getattr(dbms, 'pk', dbms), getattr(hardware, 'pk', hardware),
+            task_type)
+
+    def save(self, *args, **kwargs):
+        super(PipelineResult, self).save(*args, **kwargs)
+        cache.delete(PipelineResult._get_latest_cache_key(
+            self.dbms_id, self.hardware_id, self.task_type))
 
     class Meta:
         unique_together = ("dbms", "hardware",
                            "creation_timestamp", "task_type")
+        index_together = [("dbms", "hardware",
+                           "task_type", "creation_timestamp")]
         get_latest_by = ('creation_timestamp')
 
 
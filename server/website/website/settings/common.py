@@ -35,6 +35,21 @@ LOG_DIR = join(PROJECT_ROOT, 'log')
 FILE_UPLOAD_DIRECTORY_PERMISSIONS = 0o664
 FILE_UPLOAD_PERMISSIONS = 0o664
 
+# Memory budget (in bytes) of the per-worker cache of loaded pipeline
+# result artifacts
+PIPELINE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# GPR models trained on more than this many samples use the sparse
+# (inducing-point) approximation with GPR_NUM_INDUCING inducing points.
+# Set it to None to always fit the exact model or to 0 to always fit the
+# sparse one.
+GPR_SPARSE_MIN_SAMPLES = 5000
+GPR_NUM_INDUCING = 500
+
+# Whether to fit the GPR length scale, magnitude and ridge scale by
+# maximizing the log marginal likelihood instead of using the defaults
+GPR_FIT_HYPERPARAMETERS = False
+
 # Path to OtterTune's ML modules
 OTTERTUNE_LIBS = dirname(PROJECT_ROOT)#join(dirname(PROJECT_ROOT), 'analysis')
 
@@ -212,6 +227,10 @@ CELERYD_MAX_TASKS_PER_CHILD = 50
 # Number of concurrent workers.
 CELERYD_CONCURRENCY = 8
 
+# Number of threads the map_workload task uses to score the workloads
+# in parallel. Set to 1 to score them serially.
+MAP_WORKLOAD_POOL_SIZE = 4
+
 djcelery.setup_loader()
 
 ## ==============================================
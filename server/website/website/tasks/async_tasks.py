@@ -1,22 +1,30 @@
 import itertools
+import logging
 import numpy as np
 import os.path
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from celery.task import task, Task
 from django.utils.timezone import now
 from djcelery.models import TaskMeta
 from sklearn.preprocessing import StandardScaler
 
-from analysis.gp_tf import GPR, GPR_GD
+from analysis.gp_tf import (GPR, GPR_GD, SESSION_POOL, SparseGPR,
+                            SparseGPR_GD)
 from analysis.preprocessing import bin_by_decile, Bin
 from website.models import (DBMSCatalog, Hardware, KnobCatalog, PipelineResult,
                             Result, ResultData, WorkloadCluster)
-from website.settings import PIPELINE_DIR
+from website.settings import (GPR_FIT_HYPERPARAMETERS, GPR_NUM_INDUCING,
+                              GPR_SPARSE_MIN_SAMPLES, MAP_WORKLOAD_POOL_SIZE,
+                              PIPELINE_DIR)
 from website.types import KnobUnitType, PipelineTaskType, VarType
-from website.utils import (ConversionUtil, DataUtil, DBMSUtil, JSONUtil,
+from website.utils import (ARTIFACT_CACHE, ArtifactUtil, ConversionUtil,
+                           DataUtil, DBMSUtil, JSONUtil, LabelMismatchError,
                            MediaUtil, PostgresUtilImpl)
 
+LOG = logging.getLogger(__name__)
+
 
 class UpdateTask(Task):
 
@@ -77,27 +85,76 @@ class ConfigurationRecommendation(UpdateTask):
         with open(path, 'w') as f:
             f.write(config)
 
+def get_target_data_path(app_id, dbms_id):
+    return os.path.join(PIPELINE_DIR, 'TARGETDATA_{}_{}.npz'.format(
+        app_id, dbms_id))
+
+
 @task(base=AggregateTargetResults, name='aggregate_target_results')
 def aggregate_target_results(result_id):
     newest_result = Result.objects.get(pk=result_id)
-    target_results = Result.objects.filter(
-        application=newest_result.application, dbms=newest_result.dbms)
-    if len(target_results) == 0:
-        raise Exception('Cannot find any results for app_id={}, dbms_id={}'
-                        .format(newest_result.application, newest_result.dbms))
-    target_result_datas = [ResultData.objects.get(
-        result=tres) for tres in target_results]
-
-    knob_labels = np.asarray(sorted(JSONUtil.loads(
-        target_result_datas[0].param_data).keys()))
-    metric_labels = np.asarray(sorted(JSONUtil.loads(
-        target_result_datas[0].metric_data).keys()))
-    agg_data = DataUtil.aggregate_data(
-        target_result_datas, knob_labels, metric_labels)
+    app = newest_result.application
+    dbms = newest_result.dbms
+    target_result_datas = ResultData.objects.filter(
+        result__application=app, result__dbms=dbms).order_by('pk')
+
+    # The target data is cached on disk for each application so only the
+    # results uploaded since the last call need to be aggregated. If there
+    # is no usable cache (or some of its results were deleted) then all
+    # results are aggregated from scratch.
+    cache_path = get_target_data_path(app.pk, dbms.pk)
+    cached_data = None
+    if os.path.exists(cache_path):
+        cached_data = dict(np.load(cache_path))
+        new_result_datas = get_new_results(target_result_datas,
+                                           cached_data['rowlabels'])
+        if new_result_datas is None:
+            LOG.info("Results of app_id=%s, dbms_id=%s were deleted; "
+                     "rebuilding the cached target data", app.pk, dbms.pk)
+            cached_data = None
+        elif len(new_result_datas) > 0:
+            try:
+                new_data = DataUtil.aggregate_data(
+                    new_result_datas, cached_data['X_columnlabels'],
+                    cached_data['y_columnlabels'])
+            except (LabelMismatchError, KeyError) as e:
+                # The knobs/metrics changed so the cache is stale
+                LOG.warning("Dropping the cached target data for app_id=%s, "
+                            "dbms_id=%s: %s", app.pk, dbms.pk, e)
+                cached_data = None
+            else:
+                for name in ('X_matrix', 'y_matrix', 'rowlabels'):
+                    cached_data[name] = np.concatenate(
+                        [cached_data[name], new_data[name]])
+                save_target_data(cache_path, cached_data)
+
+    if cached_data is None:
+        target_result_datas = list(target_result_datas)
+        if len(target_result_datas) == 0:
+            raise Exception('Cannot find any results for app_id={}, dbms_id={}'
+                            .format(app, dbms))
+        knob_labels = np.asarray(sorted(JSONUtil.loads(
+            target_result_datas[0].param_data).keys()))
+        metric_labels = np.asarray(sorted(JSONUtil.loads(
+            target_result_datas[0].metric_data).keys()))
+        cached_data = DataUtil.aggregate_data(
+            target_result_datas, knob_labels, metric_labels)
+        save_target_data(cache_path, cached_data)
+
+    agg_data = cached_data
     agg_data['newest_result_id'] = result_id
     return agg_data
 
 
+def save_target_data(path, data):
+    # Writes to a temporary file first so that concurrent tasks never read
+    # a partially written cache
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **data)
+    os.rename(tmp_path, path)
+
+
 @task(base=ConfigurationRecommendation, name='configuration_recommendation')
 def configuration_recommendation(target_data):
     if target_data['scores'] is None:
@@ -109,7 +166,7 @@ def configuration_recommendation(target_data):
     target_obj = newest_result.application.target_objective
     dbms_id = newest_result.dbms.pk
     hw_id = newest_result.application.hardware.pk
-    agg_data = PipelineResult.get_latest(
+    agg_data = ARTIFACT_CACHE.get_latest(
         dbms_id, hw_id, PipelineTaskType.AGGREGATED_DATA)
     if agg_data is None:
         return None
@@ -117,7 +174,7 @@ def configuration_recommendation(target_data):
     if best_wkld_id not in data_map['data']:
         raise Exception(('Cannot find mapped workload'
                          '(id={}) in aggregated data').format(best_wkld_id))
-    workload_data = np.load(data_map['data'][best_wkld_id])
+    workload_data = ARTIFACT_CACHE.load(agg_data, data_map['data'][best_wkld_id])
 
     # Mapped workload data
     X_wkld_matrix = workload_data['X_matrix']
@@ -169,11 +226,7 @@ def configuration_recommendation(target_data):
 
     # Delete any rows that appear in both the workload data and the target
     # data from the workload data
-    dups_filter = np.ones(X_wkld_matrix.shape[0], dtype=bool)
-    target_row_tups = [tuple(row) for row in X_target_matrix]
-    for i, row in enumerate(X_wkld_matrix):
-        if tuple(row) in target_row_tups:
-            dups_filter[i] = False
+    dups_filter = ~DataUtil.isin_rows(X_wkld_matrix, X_target_matrix)
     X_wkld_matrix = X_wkld_matrix[dups_filter, :]
     y_wkld_matrix = y_wkld_matrix[dups_filter, :]
     wkld_rowlabels = wkld_rowlabels[dups_filter]
@@ -205,7 +258,7 @@ def configuration_recommendation(target_data):
     ridge[X_target_matrix.shape[0]:] = 0.1
 
     # FIXME
-    num_samples = 5
+    num_samples = 100
     X_samples = np.empty((num_samples, X_scaled.shape[1]))
     for i in range(X_scaled.shape[1]):
         col_min = X_scaled[:, i].min()
@@ -213,7 +266,12 @@ def configuration_recommendation(target_data):
         X_samples[:, i] = np.random.rand(
             num_samples) * (col_max - col_min) + col_min
 
-    model = GPR_GD()
+    if use_sparse_gpr(X_scaled.shape[0]):
+        model = SparseGPR_GD(num_inducing=GPR_NUM_INDUCING)
+    else:
+        model = GPR_GD()
+    if GPR_FIT_HYPERPARAMETERS:
+        ridge = model.fit_hyperparameters(X_scaled, y_scaled, ridge)
     model.fit(X_scaled, y_scaled, ridge)
     res = model.predict(X_samples)
     best_idx = np.argmin(res.minL.ravel())
@@ -221,6 +279,7 @@ def configuration_recommendation(target_data):
     best_conf = X_scaler.inverse_transform(best_conf)
 
     conf_map = {k: best_conf[i] for i,k in enumerate(X_columnlabels)}
+    log_cache_stats('configuration_recommendation')
     return conf_map
 
 
@@ -229,16 +288,24 @@ def map_workload(target_data):
     newest_result = Result.objects.get(pk=target_data['newest_result_id'])
     dbms = newest_result.dbms.pk
     hardware = newest_result.application.hardware.pk
-    workload_data = PipelineResult.get_latest(
+    workload_data = ARTIFACT_CACHE.get_latest(
         dbms, hardware, PipelineTaskType.WORKLOAD_MAPPING_DATA)
     if workload_data is None:
         target_data['scores'] = None
         return target_data
 
     data_values = JSONUtil.loads(workload_data.value)
-    X_scaler = np.load(data_values['X_scaler'])
-    y_scaler = np.load(data_values['y_scaler'])
-    y_deciles = np.load(data_values['y_deciles'])['deciles']
+    model_paths = data_values.get('models')
+    if model_paths is None:
+        # Mapping data created before the models were persisted
+        LOG.warning("Workload mapping data (id=%d) has no fitted models so "
+                    "they are fit on the fly; rerun "
+                    "create_workload_mapping_data to avoid this",
+                    workload_data.pk)
+    X_scaler = ARTIFACT_CACHE.load(workload_data, data_values['X_scaler'])
+    y_scaler = ARTIFACT_CACHE.load(workload_data, data_values['y_scaler'])
+    y_deciles = ARTIFACT_CACHE.load(
+        workload_data, data_values['y_deciles'])['deciles']
     X_columnlabels = data_values['X_columnlabels']
     y_columnlabels = data_values['y_columnlabels']
 
@@ -254,20 +321,24 @@ def map_workload(target_data):
     for i in range(y_target.shape[1]):
         y_binned[:, i] = bin_by_decile(y_target[:, i], y_deciles[i])
 
-    scores = {}
-    for wkld_id, wkld_entry_path in data_values['data'].iteritems():
-        wkld_entry = np.load(wkld_entry_path)
-        preds = np.empty_like(y_target)
-        X_wkld = wkld_entry['X_matrix']
-        for j in range(y_target.shape[1]):
-            y_col = wkld_entry['y_matrix'][:, j].reshape(X_wkld.shape[0], 1)
-            model = GPR()
-            model.fit(X_wkld, y_col, ridge=0.01)
-            preds[:, j] = bin_by_decile(model.predict(
-                X_target).ypreds.ravel(), y_deciles[j])
-        dists = np.sqrt(
-            np.sum(np.square(np.subtract(preds, y_target)), axis=1))
-        scores[wkld_id] = np.mean(dists)
+    # The workload models are fit once by create_workload_mapping_data so
+    # only predictions are needed here. The workloads are scored by a pool
+    # of threads rather than processes since celery's worker processes
+    # cannot have children (TF releases the GIL while it computes).
+    iterable = [(wkld_id, workload_data, data_path,
+                 model_paths[wkld_id] if model_paths is not None else None,
+                 X_target, y_target, y_deciles)
+                for wkld_id, data_path in data_values['data'].iteritems()]
+    pool_size = min(len(iterable), MAP_WORKLOAD_POOL_SIZE)
+    if pool_size > 1:
+        pool = ThreadPool(pool_size)
+        try:
+            scores = dict(pool.map(score_workload, iterable))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = dict(map(score_workload, iterable))
 
     # Find the best (minimum) score
     best_score = np.inf
@@ -278,20 +349,111 @@ def map_workload(target_data):
             best_wkld_id = wkld_id
     target_data['mapped_workload'] = (best_wkld_id, best_score)
     target_data['scores'] = scores
+    log_cache_stats('map_workload')
     return target_data
 
 
+def log_cache_stats(task_name):
+    # The caches live as long as the worker process so these are running
+    # totals rather than per-task counts
+    LOG.info("%s: artifact cache %s, session pool hits=%d misses=%d "
+             "entries=%d", task_name, ARTIFACT_CACHE.stats(),
+             SESSION_POOL.hits, SESSION_POOL.misses, len(SESSION_POOL))
+
+
+def use_sparse_gpr(num_samples):
+    return GPR_SPARSE_MIN_SAMPLES is not None and \
+        num_samples > GPR_SPARSE_MIN_SAMPLES
+
+
+def score_workload((wkld_id, workload_data, data_path, model_path, X_target,
+                    y_target, y_deciles)):
+    if model_path is not None:
+        model = GPR.load_model(model_path)
+    else:
+        workload = ARTIFACT_CACHE.load(workload_data, data_path)
+        X_wkld = workload['X_matrix']
+        if use_sparse_gpr(X_wkld.shape[0]):
+            model = SparseGPR(num_inducing=GPR_NUM_INDUCING)
+        else:
+            model = GPR()
+        model.fit(X_wkld, workload['y_matrix'], ridge=0.01)
+    ypreds = model.predict(X_target).ypreds
+    preds = np.empty_like(y_target)
+    for j in range(y_target.shape[1]):
+        preds[:, j] = bin_by_decile(ypreds[:, j], y_deciles[j])
+    dists = np.sqrt(
+        np.sum(np.square(np.subtract(preds, y_target)), axis=1))
+    return wkld_id, np.mean(dists)
+
+
+def get_aggregated_data(dbms_id, hw_id):
+    # Returns {cluster_id: path} for the clusters in the latest aggregated
+    # data
+    agg_data = PipelineResult.get_latest(
+        dbms_id, hw_id, PipelineTaskType.AGGREGATED_DATA)
+    if agg_data is None:
+        return {}
+    value = JSONUtil.loads(agg_data.value)
+    return {int(cluster_id): path
+            for cluster_id, path in value['data'].iteritems()}
+
+
+def get_new_results(results, prev_rowlabels):
+    # Returns the results in the queryset that are not among the previously
+    # aggregated rowlabels, or None if some of those rows no longer exist
+    # (e.g., their results or application were deleted). Results can commit
+    # out of pk order so the new ones are found by comparing the pks rather
+    # than by taking those above the largest aggregated pk.
+    pks = np.fromiter(results.values_list('pk', flat=True), dtype=int)
+    if not np.all(np.in1d(prev_rowlabels, pks)):
+        return None
+    new_pks = np.setdiff1d(pks, prev_rowlabels)
+    if new_pks.size == 0:
+        return []
+    new_pks = set(new_pks.tolist())
+    return [r for r in results.filter(pk__gte=min(new_pks))
+            if r.pk in new_pks]
+
+
 @task(name='aggregate_results')
-def aggregate_results():
+def aggregate_results(incremental=True):
+    # In incremental mode only the results added since the last run are
+    # aggregated and appended to the previous matrices. A cluster's
+    # matrices are rebuilt from scratch if any of their results have been
+    # deleted. Run it with incremental=False to rebuild all of them.
     unique_clusters = WorkloadCluster.objects.all()
     unique_clusters = filter(lambda x: x.isdefault is False, unique_clusters)
     all_data = {}
     all_labels = {}
+    prev_data = {}
     for cluster in unique_clusters:
-        results = ResultData.objects.filter(cluster=cluster)
-        if len(results) < 2:
+        key = (cluster.dbms.pk, cluster.hardware.pk)
+        if key not in prev_data:
+            prev_data[key] = get_aggregated_data(*key) if incremental else {}
+        results = ResultData.objects.filter(cluster=cluster).order_by('pk')
+
+        prev_entry = None
+        if cluster.pk in prev_data[key]:
+            prev_path = prev_data[key][cluster.pk]
+            prev_entry = ArtifactUtil.load(prev_path)
+            new_results = get_new_results(results, prev_entry['rowlabels'])
+            if new_results is None:
+                LOG.info("Results of cluster %s were deleted; rebuilding its "
+                         "aggregated data", cluster.pk)
+                prev_entry = None
+            elif len(new_results) == 0:
+                # Nothing new so the previous file is reused as is
+                all_data.setdefault(key, {})[cluster.pk] = prev_path
+                continue
+            else:
+                results = new_results
+        if prev_entry is not None:
+            knob_labels = prev_entry['X_columnlabels']
+            metric_labels = prev_entry['y_columnlabels']
+        elif len(results) < 2:
             continue
-        if cluster.dbms.pk not in all_labels:
+        elif cluster.dbms.pk not in all_labels:
             knob_labels = np.asarray(
                 sorted(JSONUtil.loads(results[0].param_data).keys()))
             metric_labels = np.asarray(
@@ -300,10 +462,10 @@ def aggregate_results():
         else:
             knob_labels, metric_labels = all_labels[cluster.dbms.pk]
         entry = DataUtil.aggregate_data(results, knob_labels, metric_labels)
-        key = (cluster.dbms.pk, cluster.hardware.pk)
-        if key not in all_data:
-            all_data[key] = {}
-        all_data[key][cluster.pk] = entry
+        if prev_entry is not None:
+            for name in ('X_matrix', 'y_matrix', 'rowlabels'):
+                entry[name] = np.concatenate([prev_entry[name], entry[name]])
+        all_data.setdefault(key, {})[cluster.pk] = entry
 
     ts = now()
     tsf = ts.strftime("%Y%m%d-%H%M%S")
@@ -312,11 +474,14 @@ def aggregate_results():
             PipelineTaskType.AGGREGATED_DATA].replace(' ', '').upper()
         savepaths = {}
         for clusterkey, entry in cluster_data.iteritems():
-            fname = '{}_{}_{}_{}_{}.npz'.format(
+            if not isinstance(entry, dict):
+                # Unchanged since the last run
+                savepaths[clusterkey] = entry
+                continue
+            fname = '{}_{}_{}_{}_{}'.format(
                 task_name, dbkey, hwkey, clusterkey, tsf)
             savepath = os.path.join(PIPELINE_DIR, fname)
-            savepaths[clusterkey] = savepath
-            np.savez_compressed(savepath, **entry)
+            savepaths[clusterkey] = ArtifactUtil.save(savepath, **entry)
 
         value = {
             'data': savepaths
@@ -339,12 +504,12 @@ def create_workload_mapping_data():
     hardwares = set([ad.hardware.pk for ad in agg_datas])
 
     for dbms_id, hw_id in itertools.product(dbmss, hardwares):
-        data = PipelineResult.get_latest(
+        data = ARTIFACT_CACHE.get_latest(
             dbms_id, hw_id, PipelineTaskType.AGGREGATED_DATA)
         file_info = JSONUtil.loads(data.value)
         cluster_data = OrderedDict()
         for cluster, path in file_info['data'].iteritems():
-            compressed_data = np.load(path)
+            compressed_data = ARTIFACT_CACHE.load(data, path)
             X_matrix = compressed_data['X_matrix']
             y_matrix = compressed_data['y_matrix']
             X_columnlabels = compressed_data['X_columnlabels']
@@ -393,29 +558,45 @@ def create_workload_mapping_data():
         timestamp = data.creation_timestamp
         tsf = timestamp.strftime("%Y%m%d-%H%M%S")
         savepaths = {}
+        modelpaths = {}
         for cluster, entry in cluster_data.iteritems():
             X_scaler.transform(entry['X_matrix'])
             y_scaler.transform(entry['y_matrix'])
-            fname = '{}_{}_{}_{}_{}.npz'.format(
+            fname = '{}_{}_{}_{}_{}'.format(
                 task_name, dbms_id, hw_id, cluster, tsf)
             savepath = os.path.join(PIPELINE_DIR, fname)
-            savepaths[cluster] = savepath
-            np.savez_compressed(savepath, **entry)
-
-        X_scaler_path = os.path.join(
-            PIPELINE_DIR, '{}_XSCALER_{}_{}_{}.npz'.format(task_name, dbms_id, hw_id, tsf))
-        np.savez_compressed(
-            X_scaler_path, mean=X_scaler.mean_, scale=X_scaler.scale_)
-        y_scaler_path = os.path.join(
-            PIPELINE_DIR, '{}_YSCALER_{}_{}_{}.npz'.format(task_name, dbms_id, hw_id, tsf))
-        np.savez_compressed(
-            y_scaler_path, mean=y_scaler.mean_, scale=y_scaler.scale_)
-        y_deciles_path = os.path.join(
-            PIPELINE_DIR, '{}_YDECILES_{}_{}_{}.npz'.format(task_name, dbms_id, hw_id, tsf))
-        np.savez_compressed(y_deciles_path, deciles=y_binner.deciles_)
+            savepaths[cluster] = ArtifactUtil.save(savepath, **entry)
+
+            model_dir = os.path.join(PIPELINE_DIR, '{}_MODEL_{}_{}_{}_{}'.format(
+                task_name, dbms_id, hw_id, cluster, tsf))
+            # Fit the GPR model used by map_workload (all metrics share
+            # the same kernel so one multi-output model is enough). Large
+            # clusters use the sparse model, which map_workload loads like
+            # any other.
+            if use_sparse_gpr(entry['X_matrix'].shape[0]):
+                model = SparseGPR(num_inducing=GPR_NUM_INDUCING)
+            else:
+                model = GPR()
+            ridge = 0.01
+            if GPR_FIT_HYPERPARAMETERS:
+                ridge = model.fit_hyperparameters(
+                    entry['X_matrix'], entry['y_matrix'], ridge)
+            model.fit(entry['X_matrix'], entry['y_matrix'], ridge=ridge)
+            modelpaths[cluster] = model.save_model(model_dir)
+
+        X_scaler_path = ArtifactUtil.save(os.path.join(
+            PIPELINE_DIR, '{}_XSCALER_{}_{}_{}'.format(task_name, dbms_id, hw_id, tsf)),
+            mean=X_scaler.mean_, scale=X_scaler.scale_)
+        y_scaler_path = ArtifactUtil.save(os.path.join(
+            PIPELINE_DIR, '{}_YSCALER_{}_{}_{}'.format(task_name, dbms_id, hw_id, tsf)),
+            mean=y_scaler.mean_, scale=y_scaler.scale_)
+        y_deciles_path = ArtifactUtil.save(os.path.join(
+            PIPELINE_DIR, '{}_YDECILES_{}_{}_{}'.format(task_name, dbms_id, hw_id, tsf)),
+            deciles=y_binner.deciles_)
 
         value = {
             'data': savepaths,
+            'models': modelpaths,
             'X_scaler': X_scaler_path,
             'y_scaler': y_scaler_path,
             'y_deciles': y_deciles_path,
@@ -0,0 +1,134 @@
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.utils.timezone import now
+
+from website import utils
+from website.models import (Application, DBMSCatalog, Hardware, KnobCatalog,
+                            MetricCatalog, Project, Result, StatsManager)
+from website.types import DBMSType, KnobUnitType, MetricType, VarType
+from website.utils import DBMSUtil, JSONUtil
+from website.views import RESULT_FILE_EXTS, handle_result_files
+
+BENCHMARK_CONFIG_FMT = """<?xml version="1.0"?>
+<parameters>
+    <isolation>TRANSACTION_SERIALIZABLE</isolation>
+    <scalefactor>1</scalefactor>
+    <terminals>{terminals}</terminals>
+    <works>
+        <work>
+            <time>60</time>
+            <rate>unlimited</rate>
+            <weights>100</weights>
+        </work>
+    </works>
+    <transactiontypes>
+        <transactiontype>
+            <name>NewOrder</name>
+        </transactiontype>
+    </transactiontypes>
+</parameters>
+""".format
+
+
+class HandleResultFilesTest(TestCase):
+
+    # Queries taken by handle_result_files to store a result (see the
+    # comment there). The knob/metric catalogs are loaded beforehand.
+    EXISTING_CONFIG_QUERIES = 11
+    NEW_CONFIG_QUERIES = 16
+    # The upload's transaction is a savepoint inside the test's
+    # transaction, which adds the SAVEPOINT and RELEASE SAVEPOINT queries
+    SAVEPOINT_QUERIES = 2
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        self.orig_upload_dir = utils.UPLOAD_DIR
+        utils.UPLOAD_DIR = self.upload_dir
+        # DBMSUtil caches the catalogs of the DBMSs it has seen
+        DBMSUtil._DBMSUtil__DBMS_UTILS_IMPLS = None
+
+        user = User.objects.create_user('test', password='test')
+        dbms = DBMSCatalog.objects.create(type=DBMSType.POSTGRES,
+                                          version='9.6')
+        KnobCatalog.objects.create(
+            dbms=dbms, name='shared_buffers', vartype=VarType.INTEGER,
+            unit=KnobUnitType.BYTES, scope='global', default='128MB',
+            context='postmaster', tunable=True)
+        KnobCatalog.objects.create(
+            dbms=dbms, name='port', vartype=VarType.INTEGER,
+            unit=KnobUnitType.OTHER, scope='global', default='5432',
+            context='postmaster', tunable=False)
+        MetricCatalog.objects.create(
+            dbms=dbms, name='pg_stat_database.xact_commit',
+            vartype=VarType.INTEGER, scope='database',
+            metric_type=MetricType.COUNTER)
+        hardware = Hardware.objects.create(
+            type=1, name='generic', cpu=4, memory=16.0, storage='32',
+            storage_type='SSD')
+        project = Project.objects.create(
+            user=user, name='project', creation_time=now(),
+            last_update=now())
+        Application.objects.create(
+            user=user, name='app', dbms=dbms, hardware=hardware,
+            project=project, creation_time=now(), last_update=now(),
+            upload_code='TESTUPLOADCODE', tuning_session=False)
+
+    def tearDown(self):
+        utils.UPLOAD_DIR = self.orig_upload_dir
+        DBMSUtil._DBMSUtil__DBMS_UTILS_IMPLS = None
+        shutil.rmtree(self.upload_dir)
+
+    def get_app(self):
+        # Fetched the same way as in new_result
+        return Application.objects.select_related(
+            'project', 'dbms', 'hardware').get(upload_code='TESTUPLOADCODE')
+
+    def create_files(self, shared_buffers='128MB', terminals=4):
+        summary = {
+            'DBMS Type': 'postgres',
+            'DBMS Version': '9.6.3',
+            'Benchmark Type': 'tpcc',
+            'Current Timestamp (milliseconds)': 1500000000000,
+            'Throughput (requests/second)': 100.0,
+            'Latency Distribution': {
+                meta.pprint + ' (microseconds)': 1000.0
+                for name, meta in StatsManager.METRIC_META.iteritems()
+                if name != StatsManager.THROUGHPUT},
+        }
+        params = {'shared_buffers': shared_buffers, 'port': '5432'}
+        metrics = {'pg_stat_database': [{'xact_commit': '100'},
+                                        {'xact_commit': '50'}]}
+        contents = {
+            'summary_data': JSONUtil.dumps(summary),
+            'db_parameters_data': JSONUtil.dumps(params),
+            'db_metrics_data': JSONUtil.dumps(metrics),
+            'benchmark_conf_data': BENCHMARK_CONFIG_FMT(terminals=terminals),
+        }
+        return {name: SimpleUploadedFile(name + ext, contents[name])
+                for ext, name in RESULT_FILE_EXTS.iteritems()}
+
+    def test_existing_config(self):
+        # The first upload creates the benchmark config, DBMS config and
+        # workload cluster (and loads the catalogs)
+        handle_result_files(self.get_app(), self.create_files(), 'cluster')
+        app = self.get_app()
+        files = self.create_files()
+        with self.assertNumQueries(self.EXISTING_CONFIG_QUERIES +
+                                   self.SAVEPOINT_QUERIES):
+            response = handle_result_files(app, files, 'cluster')
+        self.assertEqual(response.content, 'Store success!')
+        self.assertEqual(Result.objects.count(), 2)
+
+    def test_new_config(self):
+        handle_result_files(self.get_app(), self.create_files(), 'cluster')
+        app = self.get_app()
+        files = self.create_files(shared_buffers='256MB', terminals=8)
+        with self.assertNumQueries(self.NEW_CONFIG_QUERIES +
+                                   self.SAVEPOINT_QUERIES):
+            response = handle_result_files(app, files, 'other_cluster')
+        self.assertEqual(response.content, 'Store success!')
+        self.assertEqual(Result.objects.count(), 2)
@@ -17,6 +17,7 @@ urlpatterns = [
 #     url(r'^status/', website_views.ml_info),
 
     url(r'^new_result/', website_views.new_result),
+    url(r'^new_result_batch/', website_views.new_result_batch),
 #     url(r'^result/', website_views.result),
     url(r'^get_result_data_file/', website_views.get_result_data_file),
     url(r'^update_similar/', website_views.update_similar),
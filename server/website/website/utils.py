@@ -4,23 +4,29 @@ Created on Jul 8, 2017
 @author: dvanaken
 '''
 
+import errno
+import hashlib
 import json
 import logging
 import numpy as np
 import os.path
 import re
 import string
+import tempfile
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import OrderedDict
 from random import choice
+from threading import Lock
 
 import mimetypes
+from analysis.util import get_grouped_median
 from django.http import StreamingHttpResponse
 from django.utils.text import capfirst
 from wsgiref.util import FileWrapper
 
-from .models import DBMSCatalog, KnobCatalog, MetricCatalog
-from .settings import CONFIG_DIR, UPLOAD_DIR
+from .models import DBMSCatalog, KnobCatalog, MetricCatalog, PipelineResult
+from .settings import (CONFIG_DIR, FILE_UPLOAD_PERMISSIONS,
+                       PIPELINE_CACHE_MAX_BYTES, UPLOAD_DIR)
 from .types import (BooleanType, DBMSType, LabelStyleType, MetricType,
                     VarType, KnobUnitType)
 
@@ -35,6 +41,12 @@ class JSONUtil(object):
                           encoding="UTF-8",
                           object_pairs_hook=OrderedDict)
 
+    @staticmethod
+    def load(config_file):
+        return json.load(config_file,
+                         encoding="UTF-8",
+                         object_pairs_hook=OrderedDict)
+
     @staticmethod
     def dumps(config, pprint=False, sort=False):
         indent = 4 if pprint is True else None
@@ -61,6 +73,28 @@ class MediaUtil(object):
                 pass
         return os.path.join(result_path, str(int(result_id) / 100l))
 
+    @staticmethod
+    def write_staging_file(chunks):
+        # Streams the chunks to a new file in the upload directory so that it
+        # can later be renamed to its result data path. Returns the path.
+        try:
+            os.makedirs(UPLOAD_DIR)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, path = tempfile.mkstemp(prefix='.staging_', dir=UPLOAD_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(path, FILE_UPLOAD_PERMISSIONS)
+        return path
+
+    @staticmethod
+    def remove_files(paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
     @staticmethod
     def upload_code_generator(size=20,
                               chars=string.ascii_uppercase + string.digits):
@@ -77,8 +111,149 @@ class MediaUtil(object):
         return response
 
 
+class ArtifactUtil(object):
+
+    NPY_EXT = '.npy'
+
+    @staticmethod
+    def save(path, **arrays):
+        # Saves each array as an uncompressed .npy file in the directory at
+        # path so that it can be memory-mapped by load()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for name, arr in arrays.iteritems():
+            np.save(os.path.join(path, name + ArtifactUtil.NPY_EXT),
+                    np.asarray(arr))
+        return path
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        # Returns a dict mapping each array name to its (memory-mapped)
+        # array. Artifacts written as .npz files are still supported but
+        # are loaded lazily by np.load instead.
+        if not os.path.isdir(path):
+            return np.load(path)
+        arrays = {}
+        for fname in os.listdir(path):
+            name, ext = os.path.splitext(fname)
+            if ext == ArtifactUtil.NPY_EXT:
+                arrays[name] = np.load(os.path.join(path, fname),
+                                       mmap_mode=mmap_mode)
+        return arrays
+
+
+class ArtifactCache(object):
+
+    def __init__(self, max_bytes=PIPELINE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_ = 0
+        # Maps (pipeline result id, path) -> (arrays, nbytes) in LRU order
+        self.entries_ = OrderedDict()
+        # Maps (dbms, hardware, task_type) -> id of the latest result seen
+        self.latest_ids_ = {}
+        self.lock_ = Lock()
+
+    def get_latest(self, dbms, hardware, task_type):
+        # Same as PipelineResult.get_latest except that the artifacts of
+        # an older result are evicted once a newer one is created
+        result = PipelineResult.get_latest(dbms, hardware, task_type)
+        if result is not None:
+            with self.lock_:
+                key = (dbms, hardware, task_type)
+                old_id = self.latest_ids_.get(key)
+                if old_id is not None and old_id != result.pk:
+                    self._invalidate(old_id)
+                self.latest_ids_[key] = result.pk
+        return result
+
+    def load(self, pipeline_result, path):
+        # Returns the arrays stored at path (see ArtifactUtil.load), which
+        # belongs to pipeline_result
+        key = (pipeline_result.pk, path)
+        with self.lock_:
+            if key in self.entries_:
+                entry = self.entries_.pop(key)
+                self.entries_[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        arrays = ArtifactUtil.load(path)
+        if not isinstance(arrays, dict):
+            # Legacy .npz files are read into memory so they are only
+            # decompressed once
+            arrays = {name: arrays[name] for name in arrays.files}
+            for arr in arrays.values():
+                # Cached arrays are shared so they must not be modified
+                arr.flags.writeable = False
+        nbytes = sum(arr.nbytes for arr in arrays.values())
+        if nbytes > self.max_bytes:
+            return arrays
+        with self.lock_:
+            if key not in self.entries_:
+                while self.size_ + nbytes > self.max_bytes:
+                    _, (_, evicted_nbytes) = self.entries_.popitem(last=False)
+                    self.size_ -= evicted_nbytes
+                    self.evictions += 1
+                self.entries_[key] = (arrays, nbytes)
+                self.size_ += nbytes
+        return arrays
+
+    def stats(self):
+        with self.lock_:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries_),
+                'bytes': self.size_,
+            }
+
+    def clear(self):
+        with self.lock_:
+            self.entries_.clear()
+            self.latest_ids_.clear()
+            self.size_ = 0
+
+    def _invalidate(self, result_id):
+        for key in [k for k in self.entries_ if k[0] == result_id]:
+            _, nbytes = self.entries_.pop(key)
+            self.size_ -= nbytes
+
+
+ARTIFACT_CACHE = ArtifactCache()
+
+
+class LabelMismatchError(Exception):
+    pass
+
+
 class DataUtil(object):
 
+    @staticmethod
+    def get_schema_version(knob_labels, metric_labels):
+        sha = hashlib.sha1()
+        for labels in (knob_labels, metric_labels):
+            for label in labels:
+                sha.update(unicode(label).encode('utf-8'))
+                sha.update('\0')
+            sha.update('\1')
+        return sha.hexdigest()
+
+    @staticmethod
+    def encode_values(data, labels):
+        return np.asarray([data[l] for l in labels], dtype=np.float64).tostring()
+
+    @staticmethod
+    def decode_values(buffers, num_labels):
+        return np.frombuffer(''.join(bytes(b) for b in buffers),
+                             dtype=np.float64).reshape(-1, num_labels)
+
     @staticmethod
     def aggregate_data(results, knob_labels, metric_labels):
         X_matrix_shape = (len(results), len(knob_labels))
@@ -87,22 +262,38 @@ class DataUtil(object):
         y_matrix = np.empty(y_matrix_shape, dtype=float)
         rowlabels = np.empty(X_matrix_shape[0], dtype=int)
 
+        # Rows stored with the same schema are decoded together and the
+        # rest fall back to parsing the JSON data
+        schema_version = DataUtil.get_schema_version(knob_labels, metric_labels)
+        binary_idxs = []
+        param_buffers = []
+        metric_buffers = []
         for i, result in enumerate(results):
+            rowlabels[i] = result.pk
+            if result.schema_version == schema_version:
+                binary_idxs.append(i)
+                param_buffers.append(result.param_values)
+                metric_buffers.append(result.metric_values)
+                continue
             param_data = JSONUtil.loads(result.param_data)
             if len(param_data) != len(knob_labels):
-                raise Exception(
+                raise LabelMismatchError(
                     ("Incorrect number of knobs "
                      "(expected={}, actual={})").format(len(knob_labels),
                                                         len(param_data)))
             metric_data = JSONUtil.loads(result.metric_data)
             if len(metric_data) != len(metric_labels):
-                raise Exception(
+                raise LabelMismatchError(
                     ("Incorrect number of metrics "
                      "(expected={}, actual={})").format(len(metric_labels),
                                                         len(metric_data)))
             X_matrix[i, :] = [param_data[l] for l in knob_labels]
             y_matrix[i, :] = [metric_data[l] for l in metric_labels]
-            rowlabels[i] = result.pk
+        if len(binary_idxs) > 0:
+            X_matrix[binary_idxs] = DataUtil.decode_values(
+                param_buffers, len(knob_labels))
+            y_matrix[binary_idxs] = DataUtil.decode_values(
+                metric_buffers, len(metric_labels))
         return {
             'X_matrix': X_matrix,
             'y_matrix': y_matrix,
@@ -111,30 +302,49 @@ class DataUtil(object):
             'y_columnlabels': metric_labels,
         }
 
+    @staticmethod
+    def get_row_keys(matrix):
+        # Returns a 1-D array with one hashable/sortable key per row by
+        # viewing each row of the (float64) matrix as a single void scalar.
+        # Adding 0.0 turns -0.0 into 0.0 so that equal rows get equal keys.
+        matrix = np.ascontiguousarray(np.asarray(matrix, dtype=np.float64) + 0.0)
+        return matrix.view(np.dtype(
+            (np.void, matrix.dtype.itemsize * matrix.shape[1]))).ravel()
+
+    @staticmethod
+    def isin_rows(matrix, other):
+        # Returns a boolean mask that is True for each row of matrix that
+        # also appears in other
+        return np.in1d(DataUtil.get_row_keys(matrix),
+                       DataUtil.get_row_keys(other))
+
+    @staticmethod
+    def unique_rows(matrix):
+        # Same as np.unique(matrix, axis=0, return_index=True,
+        # return_inverse=True, return_counts=True) but the unique rows are
+        # ordered by their keys rather than lexicographically
+        _, idxs, invs, cts = np.unique(DataUtil.get_row_keys(matrix),
+                                       return_index=True,
+                                       return_inverse=True,
+                                       return_counts=True)
+        return matrix[idxs], idxs, invs, cts
+
     @staticmethod
     def combine_duplicate_rows(X_matrix, y_matrix, rowlabels):
-        X_unique, idxs, invs, cts = np.unique(X_matrix,
-                                              return_index=True,
-                                              return_inverse=True,
-                                              return_counts=True,
-                                              axis=0)
+        X_unique, idxs, invs, cts = DataUtil.unique_rows(X_matrix)
         num_unique = X_unique.shape[0]
         if num_unique == X_matrix.shape[0]:
             # No duplicate rows
             return X_matrix, y_matrix, rowlabels
 
         # Combine duplicate rows
-        y_unique = np.empty((num_unique, y_matrix.shape[1]))
+        y_unique = get_grouped_median(y_matrix, invs)
         rowlabels_unique = np.empty(num_unique, dtype=tuple)
-        ix = np.arange(X_matrix.shape[0])
-        for i, count in enumerate(cts):
-            if count == 1:
-                y_unique[i, :] = y_matrix[idxs[i], :]
-                rowlabels_unique[i] = (rowlabels[idxs[i]],)
-            else:
-                dup_idxs = ix[invs == i]
-                y_unique[i, :] = np.median(y_matrix[dup_idxs, :], axis=0)
-                rowlabels_unique[i] = tuple(rowlabels[dup_idxs])
+        grouped_rowlabels = np.split(
+            np.asarray(rowlabels)[np.argsort(invs, kind='mergesort')],
+            np.cumsum(cts)[:-1])
+        for i, labels in enumerate(grouped_rowlabels):
+            rowlabels_unique[i] = tuple(labels)
         return X_unique, y_unique, rowlabels_unique
 
 
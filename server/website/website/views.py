@@ -1,7 +1,10 @@
 import logging
+import os.path
 import pdb
+import tarfile
 
 from collections import OrderedDict
+from contextlib import closing
 from pytz import timezone
 
 from django.contrib.auth import login, logout
@@ -9,6 +12,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.http import Http404, HttpResponse, QueryDict
 from django.shortcuts import redirect, render, get_object_or_404
 from django.template.context_processors import csrf
@@ -19,13 +23,14 @@ from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
 from djcelery.models import TaskMeta
 
-from .forms import ApplicationForm, NewResultForm, ProjectForm
+from .forms import (ApplicationForm, NewResultBatchForm, NewResultForm,
+                    ProjectForm)
 from .models import (Application, BenchmarkConfig, DBConf, DBMSCatalog,
                      DBMSMetrics, Hardware, KnobCatalog, MetricCatalog, PipelineResult, Project, Result,
                      ResultData, Statistics, WorkloadCluster)
 from tasks import aggregate_target_results, map_workload, configuration_recommendation
 from .types import DBMSType, KnobUnitType, MetricType, PipelineTaskType, StatsType, TaskType, VarType
-from .utils import DBMSUtil, JSONUtil, LabelUtil, MediaUtil
+from .utils import DataUtil, DBMSUtil, JSONUtil, LabelUtil, MediaUtil
 from website.types import HardwareType
 
 log = logging.getLogger(__name__)
@@ -399,6 +404,26 @@ def update_application(request, project_id, app_id=''):
         return render(request, 'edit_application.html', context)
 
 
+# Maps the file extension of each file in a result bundle to the name of
+# its upload field
+RESULT_FILE_EXTS = OrderedDict([
+    ('.summary', 'summary_data'),
+    ('.params', 'db_parameters_data'),
+    ('.metrics', 'db_metrics_data'),
+    ('.expconfig', 'benchmark_conf_data'),
+])
+
+# Number of rows inserted per query by bulk_create
+BULK_CREATE_BATCH_SIZE = 500
+
+# Size of the chunks (in bytes) read from the files in a results archive
+STAGING_CHUNK_SIZE = 64 * 2 ** 10
+
+
+class ResultUploadError(Exception):
+    pass
+
+
 @csrf_exempt
 def new_result(request):
     if request.method == 'POST':
@@ -410,7 +435,8 @@ def new_result(request):
         upload_code = form.cleaned_data['upload_code']
         cluster_name = form.cleaned_data['cluster_name']
         try:
-            application = Application.objects.get(upload_code=upload_code)
+            application = Application.objects.select_related(
+                'project', 'dbms', 'hardware').get(upload_code=upload_code)
         except Application.DoesNotExist:
             log.warning("Wrong upload code: " + upload_code)
             return HttpResponse("wrong upload_code!")
@@ -420,11 +446,143 @@ def new_result(request):
     return HttpResponse("POST please\n")
 
 
+@csrf_exempt
+def new_result_batch(request):
+    if request.method == 'POST':
+        form = NewResultBatchForm(request.POST, request.FILES)
+
+        if not form.is_valid():
+            log.warning("Form is not valid:\n" + str(form))
+            return HttpResponse("Form is not valid\n" + str(form))
+        upload_code = form.cleaned_data['upload_code']
+        try:
+            application = Application.objects.select_related(
+                'project', 'dbms', 'hardware').get(upload_code=upload_code)
+        except Application.DoesNotExist:
+            log.warning("Wrong upload code: " + upload_code)
+            return HttpResponse("wrong upload_code!")
+
+        return handle_result_archive(application,
+                                     request.FILES['results_archive'])
+    log.warning("Request type was not POST")
+    return HttpResponse("POST please\n")
+
+
 def handle_result_files(app, files, cluster_name):
-    from celery import chain
+    # Each upload is streamed to disk once and parsed from there. The staged
+    # files are renamed to the result's data paths once it has been stored.
+    staged_paths = {name: MediaUtil.write_staging_file(files[name].chunks())
+                    for name in RESULT_FILE_EXTS.values()}
+    try:
+        try:
+            data = parse_result_files(app, staged_paths)
+        except ResultUploadError as e:
+            return HttpResponse(e.message)
+
+        # All models are created in a single transaction. This takes between
+        # 11 queries (the benchmark config, DBMS config and workload cluster
+        # already exist) and 16 queries (they are all new), not counting the
+        # knob/metric catalogs that DBMSUtil loads once per process (see
+        # tests.HandleResultFilesTest).
+        tuning_tasks = None
+        with transaction.atomic():
+            result, db_conf_dict = store_result(app, data, cluster_name)
+            update_application_settings(app, db_conf_dict)
+            if app.tuning_session is True:
+                tuning_tasks = create_tuning_tasks(result)
+            result.save(update_fields=['summary_stats', 'task_ids'])
+        move_result_files(result, staged_paths)
+    finally:
+        MediaUtil.remove_files(staged_paths.values())
+
+    if tuning_tasks is None:
+        return HttpResponse("Store success!")
+
+    response = queue_tuning_tasks(tuning_tasks)
+    return HttpResponse("Store Success! Running tuner... (status={})".format(
+        response.status))
+
+
+def handle_result_archive(app, archive_file):
+    # Each result bundle in the (optionally compressed) tar archive is a set
+    # of files named <cluster_name>/<name>.{summary,params,metrics,expconfig}.
+    # The archive is read as a stream, each file is staged on disk and each
+    # bundle is stored as soon as all of its files have been staged.
+    results = []
+    staged_paths = []
+    written_paths = []
+    tuning_tasks = None
+    stored = False
+    try:
+        # All results are stored in a single transaction so either every
+        # result in the archive is stored or none of them are
+        with transaction.atomic(), closing(
+                tarfile.open(fileobj=archive_file, mode='r|*')) as archive:
+            model_cache = {}
+            result_datas = []
+            pending = OrderedDict()
+            for member in archive:
+                base, ext = os.path.splitext(member.name)
+                if not member.isfile() or ext not in RESULT_FILE_EXTS:
+                    continue
+                contents = pending.setdefault(base, {})
+                member_file = archive.extractfile(member)
+                path = MediaUtil.write_staging_file(
+                    iter(lambda: member_file.read(STAGING_CHUNK_SIZE), ''))
+                staged_paths.append(path)
+                contents[RESULT_FILE_EXTS[ext]] = path
+                if len(contents) < len(RESULT_FILE_EXTS):
+                    continue
+                del pending[base]
+                try:
+                    data = parse_result_files(app, contents)
+                except ResultUploadError as e:
+                    raise ResultUploadError('{}: {}'.format(base, e.message))
+                cluster_name = os.path.basename(os.path.dirname(base)) or None
+                result, db_conf_dict = store_result(
+                    app, data, cluster_name, model_cache, result_datas)
+                result.save(update_fields=['summary_stats'])
+                written_paths.extend(move_result_files(result, contents))
+                results.append(result)
+            for base, contents in pending.iteritems():
+                missing = [name for name in RESULT_FILE_EXTS.values()
+                           if name not in contents]
+                raise ResultUploadError('{}: missing {}'.format(
+                    base, ', '.join(missing)))
+            if len(results) == 0:
+                raise ResultUploadError('The results archive is empty')
+            ResultData.objects.bulk_create(result_datas,
+                                           batch_size=BULK_CREATE_BATCH_SIZE)
+            update_application_settings(app, db_conf_dict)
+            if app.tuning_session is True:
+                # Only the newest result needs a recommendation
+                tuning_tasks = create_tuning_tasks(results[-1])
+                results[-1].save(update_fields=['task_ids'])
+        stored = True
+    except (ResultUploadError, tarfile.TarError) as e:
+        return HttpResponse('Invalid results archive: {}'.format(e))
+    finally:
+        # The transaction was rolled back if anything failed, so the files
+        # already moved to their result data paths are orphans
+        if not stored:
+            MediaUtil.remove_files(written_paths)
+        MediaUtil.remove_files(staged_paths)
+
+    if tuning_tasks is None:
+        return HttpResponse("Stored {} results!".format(len(results)))
+
+    response = queue_tuning_tasks(tuning_tasks)
+    return HttpResponse(("Stored {} results! Running tuner... "
+                         "(status={})").format(len(results), response.status))
+
+
+def parse_result_files(app, paths):
+    # Parses the result files from disk. paths maps the name of the upload
+    # field of each file to its path.
 
     # Load summary file and verify that the database/version is supported
-    summary = JSONUtil.loads(''.join(files['summary_data'].chunks()))
+    with open(paths['summary_data']) as f:
+        summary = JSONUtil.load(f)
     dbms_type = DBMSType.type(summary['DBMS Type'])
     # FIXME! bad hack until I have time to get the PG 9.3 metric/knob data in
     # the same form
@@ -432,36 +590,68 @@ def handle_result_files(app, files, cluster_name):
 #     dbms_version = DBMSUtil.parse_version_string(
 #        dbms_type, summary['DBMS Version'])
 
-    try:
-        dbms_object = DBMSCatalog.objects.get(
-            type=dbms_type, version=dbms_version)
-    except ObjectDoesNotExist:
-        return HttpResponse('{} v{} is not yet supported.'.format(
-            summary['DBMS Type'], dbms_version))
+    if app.dbms.type == dbms_type and app.dbms.version == dbms_version:
+        dbms_object = app.dbms
+    else:
+        try:
+            dbms_object = DBMSCatalog.objects.get(
+                type=dbms_type, version=dbms_version)
+        except ObjectDoesNotExist:
+            raise ResultUploadError('{} v{} is not yet supported.'.format(
+                summary['DBMS Type'], dbms_version))
 
     if dbms_object != app.dbms:
-        return HttpResponse('The DBMS must match the type and version '
-                            'specified when creating the application. '
-                            '(expected=' + app.dbms.full_name + ') '
-                            '(actual=' + dbms_object.full_name + ')')
+        raise ResultUploadError('The DBMS must match the type and version '
+                                'specified when creating the application. '
+                                '(expected=' + app.dbms.full_name + ') '
+                                '(actual=' + dbms_object.full_name + ')')
 
     # Load parameters, metrics, benchmark, and samples
-    db_parameters = JSONUtil.loads(
-        ''.join(files['db_parameters_data'].chunks()))
-    db_metrics = JSONUtil.loads(''.join(files['db_metrics_data'].chunks()))
-    benchmark_config_str = ''.join(files['benchmark_conf_data'].chunks())
+    with open(paths['db_parameters_data']) as f:
+        db_parameters = JSONUtil.load(f)
+    with open(paths['db_metrics_data']) as f:
+        db_metrics = JSONUtil.load(f)
+    with open(paths['benchmark_conf_data']) as f:
+        benchmark_config_str = f.read()
+    return {
+        'summary': summary,
+        'dbms': dbms_object,
+        'db_parameters': db_parameters,
+        'db_metrics': db_metrics,
+        'benchmark_config': benchmark_config_str,
+    }
 
-    benchmark_config = BenchmarkConfig.objects.create_benchmark_config(
-        app, benchmark_config_str, summary['Benchmark Type'].upper())
+
+def store_result(app, data, cluster_name, model_cache=None,
+                 result_datas=None):
+    # Creates the models for an uploaded result. The benchmark configs,
+    # DBMS configs and workload clusters are looked up in model_cache first.
+    # If result_datas is given then the new ResultData is appended to it
+    # (for bulk_create) instead of being saved. The caller must save the
+    # result's summary_stats.
+    if model_cache is None:
+        model_cache = {}
+    summary = data['summary']
+    dbms_object = data['dbms']
+    benchmark_config_str = data['benchmark_config']
+
+    key = ('benchmark_config', benchmark_config_str)
+    if key not in model_cache:
+        model_cache[key] = BenchmarkConfig.objects.create_benchmark_config(
+            app, benchmark_config_str, summary['Benchmark Type'].upper())
+    benchmark_config = model_cache[key]
 
     db_conf_dict, db_diffs = DBMSUtil.parse_dbms_config(
-        dbms_object.pk, db_parameters)
-    db_conf = DBConf.objects.create_dbconf(
-        app, JSONUtil.dumps(db_conf_dict, pprint=True, sort=True),
-        JSONUtil.dumps(db_diffs), dbms_object)
+        dbms_object.pk, data['db_parameters'])
+    db_conf_str = JSONUtil.dumps(db_conf_dict, pprint=True, sort=True)
+    key = ('db_conf', db_conf_str)
+    if key not in model_cache:
+        model_cache[key] = DBConf.objects.create_dbconf(
+            app, db_conf_str, JSONUtil.dumps(db_diffs), dbms_object)
+    db_conf = model_cache[key]
 
     db_metrics_dict, met_diffs = DBMSUtil.parse_dbms_metrics(
-            dbms_object.pk, db_metrics)
+            dbms_object.pk, data['db_metrics'])
     dbms_metrics = DBMSMetrics.objects.create_dbms_metrics(
         app, JSONUtil.dumps(db_metrics_dict, pprint=True, sort=True),
         JSONUtil.dumps(met_diffs), benchmark_config.time, dbms_object)
@@ -474,10 +664,12 @@ def handle_result_files(app, files, cluster_name):
         JSONUtil.dumps(summary, pprint=True, sort=True), timestamp)
     result.summary_stats = Statistics.objects.create_summary_stats(
         summary, result, benchmark_config.time)
-    result.save()
 
-    wkld_cluster = WorkloadCluster.objects.create_workload_cluster(
-        dbms_object, app.hardware, cluster_name)
+    key = ('cluster', cluster_name)
+    if key not in model_cache:
+        model_cache[key] = WorkloadCluster.objects.create_workload_cluster(
+            dbms_object, app.hardware, cluster_name)
+    wkld_cluster = model_cache[key]
     param_data = DBMSUtil.convert_dbms_params(
         dbms_object.pk, db_conf_dict)
     external_metrics = Statistics.objects.get_external_metrics(summary)
@@ -485,48 +677,77 @@ def handle_result_files(app, files, cluster_name):
         dbms_object.pk, db_metrics_dict, external_metrics,
         int(benchmark_config.time))
 
-    ResultData.objects.create(result=result,
-                              cluster=wkld_cluster,
-                              param_data=JSONUtil.dumps(param_data,
+    knob_labels = sorted(param_data.keys())
+    metric_labels = sorted(metric_data.keys())
+    result_data = ResultData(result=result,
+                             cluster=wkld_cluster,
+                             param_data=JSONUtil.dumps(param_data,
+                                                       pprint=True,
+                                                       sort=True),
+                             metric_data=JSONUtil.dumps(metric_data,
                                                         pprint=True,
                                                         sort=True),
-                              metric_data=JSONUtil.dumps(metric_data,
-                                                         pprint=True,
-                                                         sort=True))
+                             schema_version=DataUtil.get_schema_version(
+                                 knob_labels, metric_labels),
+                             param_values=DataUtil.encode_values(
+                                 param_data, knob_labels),
+                             metric_values=DataUtil.encode_values(
+                                 metric_data, metric_labels))
+    if result_datas is None:
+        result_data.save()
+    else:
+        result_datas.append(result_data)
+    return result, db_conf_dict
+
 
-    nondefault_settings = DBMSUtil.get_nondefault_settings(dbms_object.pk,
+def update_application_settings(app, db_conf_dict):
+    nondefault_settings = DBMSUtil.get_nondefault_settings(app.dbms.pk,
                                                            db_conf_dict)
     app.project.last_update = now()
     app.last_update = now()
     if app.nondefault_settings is None:
         app.nondefault_settings = JSONUtil.dumps(nondefault_settings)
-    app.project.save()
-    app.save()
+    app.project.save(update_fields=['last_update'])
+    app.save(update_fields=['last_update', 'nondefault_settings'])
 
-    path_prefix = MediaUtil.get_result_data_path(result.pk)
-    paths = [
-        (path_prefix + '.summary', 'summary_data'),
-        (path_prefix + '.params', 'db_parameters_data'),
-        (path_prefix + '.metrics', 'db_metrics_data'),
-        (path_prefix + '.expconfig', 'benchmark_conf_data'),
-    ]
 
-    for path, content_name in paths:
-        with open(path, 'w') as f:
-            for chunk in files[content_name].chunks():
-                f.write(chunk)
+def move_result_files(result, staged_paths):
+    # Renames the staged files of the result to its data paths. staged_paths
+    # maps the name of each upload field to the path of its staged file.
+    path_prefix = MediaUtil.get_result_data_path(result.pk)
+    paths = []
+    for ext, content_name in RESULT_FILE_EXTS.iteritems():
+        path = path_prefix + ext
+        os.rename(staged_paths[content_name], path)
+        paths.append(path)
+    return paths
+
+
+def create_tuning_tasks(result):
+    # Sets the result's task ids (the caller must save it) and returns the
+    # chain of tuning tasks for it. The chain is queued by
+    # queue_tuning_tasks once the result has been committed.
+    from celery import chain
+    from celery.utils import uuid
+
+    taskmeta_ids = [uuid() for _ in range(3)]
+    tasks = chain(aggregate_target_results.s(result.pk).set(
+                      task_id=taskmeta_ids[0]),
+                  map_workload.s().set(task_id=taskmeta_ids[1]),
+                  configuration_recommendation.s().set(
+                      task_id=taskmeta_ids[2]))
+    result.task_ids = ','.join(taskmeta_ids)
+    return tasks
 
-    if app.tuning_session is False:
-        return HttpResponse("Store success!")
 
-    response = chain(aggregate_target_results.s(result.pk),
-                     map_workload.s(),
-                     configuration_recommendation.s()).apply_async()
-    taskmeta_ids = [response.parent.parent.id, response.parent.id, response.id]
-    result.task_ids = ','.join(taskmeta_ids)
-    result.save()
-    return HttpResponse("Store Success! Running tuner... (status={})".format(
-        response.status))
+def queue_tuning_tasks(tasks):
+    # The tasks read the stored results so they must not be queued before
+    # those are committed. The upload views commit their own transaction,
+    # which requires that they do not run inside another one (i.e.
+    # ATOMIC_REQUESTS must stay off).
+    assert not transaction.get_connection().in_atomic_block, \
+        'The tuning tasks must be queued after the results are committed'
+    return tasks.apply_async()
 
 
 def filter_db_var(kv_pair, key_filters):